@@ -1,5 +1,17 @@
 from ovplatform.ov3 import Platform
 from ovhw.top import OV3
+from migen.bank.description import CSRStatus, CSRStorage
+
+def csr_kind(csr):
+    # "storage" registers only change when the host writes them, so the
+    # host may cache them. Anything the gateware can update is volatile;
+    # plain CSRs may even act on being read.
+    if isinstance(csr, CSRStorage):
+        # write_from_dev storage has a we strobe for the gateware side
+        return "status" if hasattr(csr, "we") else "storage"
+    elif isinstance(csr, CSRStatus):
+        return "status"
+    return "csr"
 
 def gen_mapfile(ov3_mod):
     # Generate mapfile for tool / sw usage
@@ -9,9 +21,14 @@ def gen_mapfile(ov3_mod):
         reg_base = 0x200 * mapaddr
         r += name.upper()+"_BASE = "+hex(reg_base)+"\n"
 
-        for n, csr in enumerate(csrs):
+        # CSRs wider than the 8 bit bus take nr consecutive addresses,
+        # most significant byte first
+        addr = reg_base
+        for csr in csrs:
             nr = (csr.size + 7)//8
-            r += "%s = %#x\n" % ((name + "_" + csr.name).upper(), reg_base + n)
+            r += "%s = %#x kind=%s width=%d\n" % ((name + "_" + csr.name).upper(),
+                    addr, csr_kind(csr), csr.size)
+            addr += nr
 
     return r
 
@@ -1,11 +1,17 @@
+import array
+import bisect
 import ctypes
 import re
+import struct
 import os
 import sys
 import queue
 import threading
 import collections
-from usb_interp import USBInterpreter
+import configparser
+import contextlib
+import hashlib
+from usb_interp import USBInterpreter, PID_TABLE, PID_TOKEN, PID_SOF, TOKEN_TABLE
 
 _lpath = (os.path.dirname(__file__))
 if _lpath == '':
@@ -45,11 +51,45 @@ FTDIDevice_Write.argtypes = [
         ]
 FTDIDevice_Write.restype = ctypes.c_int
 
+class timeval(ctypes.Structure):
+    _fields_ = [
+                ('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long),
+                ]
+
+    def __float__(self):
+        return self.tv_sec + 1e-6 * self.tv_usec
+
+class FTDIProgressSample(ctypes.Structure):
+    _fields_ = [
+                ('totalBytes', ctypes.c_uint64),
+                ('time', timeval),
+                ]
+
+class FTDIProgressInfo(ctypes.Structure):
+    _fields_ = [
+                ('first', FTDIProgressSample),
+                ('prev', FTDIProgressSample),
+                ('current', FTDIProgressSample),
+                ('totalTime', ctypes.c_double),
+                ('totalRate', ctypes.c_double),
+                ('currentRate', ctypes.c_double),
+                ('transfersInFlight', ctypes.c_int),
+                ]
+
 p_cb_StreamCallback = ctypes.CFUNCTYPE(
         ctypes.c_int,    # retval
         ctypes.POINTER(ctypes.c_uint8), # buf
         ctypes.c_int, # length
-        ctypes.c_void_p, # progress
+        ctypes.POINTER(FTDIProgressInfo), # progress
+        ctypes.c_void_p) # userdata
+
+# The same, for callers that want the buffer's address rather than a pointer
+p_cb_TransferCallback = ctypes.CFUNCTYPE(
+        ctypes.c_int,    # retval
+        ctypes.c_void_p, # buf
+        ctypes.c_int, # length
+        ctypes.POINTER(FTDIProgressInfo), # progress
         ctypes.c_void_p) # userdata
 
 FTDIDevice_ReadStream = libov.FTDIDevice_ReadStream
@@ -63,6 +103,97 @@ FTDIDevice_ReadStream.argtypes = [
         ]
 FTDIDevice_ReadStream.restype = ctypes.c_int
 
+FTDIDevice_ReadStreamEx = libov.FTDIDevice_ReadStreamEx
+FTDIDevice_ReadStreamEx.argtypes = [
+        pFTDI_Device,    # dev
+        ctypes.c_int,    # interface
+        ctypes.c_void_p, # callback
+        ctypes.c_void_p, # userdata
+        ctypes.c_int, # packetsPerTransfer
+        ctypes.c_int, # numTransfers
+        ctypes.c_int, # flags
+        ]
+FTDIDevice_ReadStreamEx.restype = ctypes.c_int
+
+FTDI_STREAM_COALESCE = 1 << 0
+
+FTDI_PACKET_SIZE = 512
+
+# FTDIStream *FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+#       FTDIStreamCallback *callback, void *userdata,
+#       int packetsPerTransfer, int numTransfers, int flags)
+FTDIStream_New = libov.FTDIStream_New
+FTDIStream_New.argtypes = [
+        pFTDI_Device,    # dev
+        ctypes.c_int,    # interface
+        ctypes.c_void_p, # callback
+        ctypes.c_void_p, # userdata
+        ctypes.c_int, # packetsPerTransfer
+        ctypes.c_int, # numTransfers
+        ctypes.c_int, # flags
+        ]
+FTDIStream_New.restype = ctypes.c_void_p
+
+# FTDIStream *FTDIStream_NewWithBuffers(..., int flags, uint8_t **buffers)
+FTDIStream_NewWithBuffers = libov.FTDIStream_NewWithBuffers
+FTDIStream_NewWithBuffers.argtypes = FTDIStream_New.argtypes + [
+        ctypes.POINTER(ctypes.c_void_p), # buffers
+        ]
+FTDIStream_NewWithBuffers.restype = ctypes.c_void_p
+
+FTDIStream_Run = libov.FTDIStream_Run
+FTDIStream_Run.argtypes = [ctypes.c_void_p]
+FTDIStream_Run.restype = ctypes.c_int
+
+FTDIStream_Stop = libov.FTDIStream_Stop
+FTDIStream_Stop.argtypes = [ctypes.c_void_p]
+
+FTDIStream_Free = libov.FTDIStream_Free
+FTDIStream_Free.argtypes = [ctypes.c_void_p]
+
+class OVPacketBatch(ctypes.Structure):
+    _fields_ = [
+                ('count', ctypes.c_int),
+                ('magic', ctypes.POINTER(ctypes.c_uint8)),
+                ('offset', ctypes.POINTER(ctypes.c_uint32)),
+                ('length', ctypes.POINTER(ctypes.c_uint16)),
+                ('flags', ctypes.POINTER(ctypes.c_uint16)),
+                ('ts', ctypes.POINTER(ctypes.c_uint32)),
+                ('payload', ctypes.POINTER(ctypes.c_uint8)),
+                ('payloadLength', ctypes.c_int),
+                ]
+
+p_cb_BatchCallback = ctypes.CFUNCTYPE(
+        ctypes.c_int,    # retval
+        ctypes.POINTER(OVPacketBatch), # batch
+        ctypes.POINTER(FTDIProgressInfo), # progress
+        ctypes.c_void_p) # userdata
+
+# OVFramer *OVFramer_New(OVBatchCallback *callback, void *userdata)
+OVFramer_New = libov.OVFramer_New
+OVFramer_New.argtypes = [p_cb_BatchCallback, ctypes.c_void_p]
+OVFramer_New.restype = ctypes.c_void_p
+
+OVFramer_Free = libov.OVFramer_Free
+OVFramer_Free.argtypes = [ctypes.c_void_p]
+
+OVFramer_GetDiscarded = libov.OVFramer_GetDiscarded
+OVFramer_GetDiscarded.argtypes = [ctypes.c_void_p]
+OVFramer_GetDiscarded.restype = ctypes.c_uint64
+
+OVFramer_GetResyncs = libov.OVFramer_GetResyncs
+OVFramer_GetResyncs.argtypes = [ctypes.c_void_p]
+OVFramer_GetResyncs.restype = ctypes.c_uint64
+
+OVFramer_GetBadChecksums = libov.OVFramer_GetBadChecksums
+OVFramer_GetBadChecksums.argtypes = [ctypes.c_void_p]
+OVFramer_GetBadChecksums.restype = ctypes.c_uint64
+
+OV_CheckDataCRC = libov.OV_CheckDataCRC
+OV_CheckDataCRC.argtypes = [ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_void_p]
+OV_CheckDataCRC.restype = ctypes.c_int
+
 # void ChandlePacket(unsigned int ts, unsigned int flags, unsigned char *buf, unsigned int len)
 ChandlePacket = libov.ChandlePacket
 ChandlePacket.argtypes = [
@@ -72,6 +203,11 @@ ChandlePacket.argtypes = [
     ctypes.c_int, # len
 ]
 
+# int OV_SetTextBuffer(size_t size, unsigned int flush_ms)
+OV_SetTextBuffer = libov.OV_SetTextBuffer
+OV_SetTextBuffer.argtypes = [ctypes.c_size_t, ctypes.c_uint]
+OV_SetTextBuffer.restype = ctypes.c_int
+
 # int FTDIEEP_Erase(FTDIDevice *dev)
 FTDIEEP_Erase = libov.FTDIEEP_Erase
 FTDIEEP_Erase.argtypes = [
@@ -90,9 +226,6 @@ FTDIEEP_CheckAndProgram.restype = ctypes.c_int
 FTDI_INTERFACE_A = 1
 FTDI_INTERFACE_B = 2
 
-# hack
-keeper = []
-
 class FTDIDevice:
     def __init__(self):
         self.__is_open = False
@@ -113,11 +246,13 @@ class FTDIDevice:
             self.__is_open = False
             FTDIDevice_Close(self._dev)
 
-    def write(self, intf, buf, async=False):
+    # async_ writes return as soon as the transfer is submitted; it completes
+    # whenever the stream's event loop next runs
+    def write(self, intf, buf, async_=False):
         if not isinstance(buf, bytes):
             raise TypeError("buf must be bytes")
 
-        return FTDIDevice_Write(self._dev, intf, buf, len(buf), async)
+        return FTDIDevice_Write(self._dev, intf, buf, len(buf), async_)
 
     def read(self, intf, n):
         buf = []
@@ -131,24 +266,34 @@ class FTDIDevice:
         return buf
 
     def read_async(self, intf, callback, packetsPerTransfer, numTransfers):
-        def callback_wrapper(buf, ll, prog, user):
-            if ll:
-                b = ctypes.string_at(buf, ll)
-            else:
-                b = b''
-            return callback(b, prog)
+        with self.stream(intf, callback, packetsPerTransfer, numTransfers) as stream:
+            return stream.run()
+
+    def read_batches(self, intf, callback, packetsPerTransfer, numTransfers):
+        with self.batch_stream(intf, callback, packetsPerTransfer, numTransfers) as stream:
+            return stream.run()
+
+    def stream(self, intf, callback, packetsPerTransfer, numTransfers):
+        """A reusable stream calling callback(b, prog) with each FTDI
+        packet's payload, or every 100ms with b'' and the stream's
+        FTDIProgressInfo (prog is None otherwise)."""
+        return FTDIStream(self, intf, callback, packetsPerTransfer, numTransfers)
+
+    def transfer_stream(self, intf, callback, packetsPerTransfer, numTransfers):
+        """A reusable stream calling callback(b, prog) once per transfer,
+        with a memoryview of its payload that's only valid during the
+        call."""
+        return FTDITransferStream(self, intf, callback, packetsPerTransfer, numTransfers)
+
+    def batch_stream(self, intf, callback, packetsPerTransfer, numTransfers):
+        """A reusable stream with framing done in libov.
+
+        callback(batch, prog) is called once per transfer with the
+        OVPacketBatch of every message completed by it, or every 100ms
+        with None and the stream's FTDIProgressInfo.
+        """
+        return FTDIBatchStream(self, intf, callback, packetsPerTransfer, numTransfers)
 
-        cb = p_cb_StreamCallback(callback_wrapper)
-
-        # HACK
-        keeper.append(cb)
-
-        return FTDIDevice_ReadStream(self._dev, intf, cb, 
-                None, packetsPerTransfer, numTransfers)
-        # uncomment next lines to use C code to parse packets
-        #return FTDIDevice_ReadStream(self._dev, intf, p_cb_StreamCallback(libov.CStreamCallback), 
-        #        cb, packetsPerTransfer, numTransfers)
-        
     def eeprom_erase(self):
         return FTDIEEP_Erase(self._dev)
 
@@ -159,6 +304,154 @@ _FPGA_GetConfigStatus = libov.FPGA_GetConfigStatus
 _FPGA_GetConfigStatus.restype = ctypes.c_int
 _FPGA_GetConfigStatus.argtypes = [pFTDI_Device]
 
+class FTDIStream:
+    """A read stream whose libusb transfers live as long as it does.
+
+    run() streams until the callback returns nonzero, an error occurs or
+    stop() is called from another thread, and may be called again to resume.
+    close() frees the transfers and drops the callback.
+    """
+    flags = 0
+
+    def __init__(self, dev, intf, callback, packetsPerTransfer, numTransfers):
+        self.callback = callback
+        self._stream = None
+
+        # The C side keeps pointers to these, so they must live as long as
+        # the stream does
+        self._cb, userdata = self._make_callback()
+
+        self._buffers = self._make_buffers(packetsPerTransfer * FTDI_PACKET_SIZE,
+                numTransfers)
+
+        self._stream = FTDIStream_NewWithBuffers(dev._dev, intf,
+                ctypes.cast(self._cb, ctypes.c_void_p), userdata,
+                packetsPerTransfer, numTransfers, self.flags, self._buffers)
+
+        if not self._stream:
+            self.close()
+            raise MemoryError("Could not allocate stream")
+
+    def _make_buffers(self, size, count):
+        # libov allocates its own
+        return None
+
+    def _make_callback(self):
+        def callback_wrapper(buf, ll, prog, user):
+            if ll:
+                b = ctypes.string_at(buf, ll)
+            else:
+                b = b''
+            return self.callback(b, prog.contents if prog else None)
+
+        return p_cb_StreamCallback(callback_wrapper), None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def run(self):
+        if not self._stream:
+            raise ValueError("Stream is closed")
+
+        return FTDIStream_Run(self._stream)
+
+    def stop(self):
+        if self._stream:
+            FTDIStream_Stop(self._stream)
+
+    def close(self):
+        if self._stream:
+            FTDIStream_Free(self._stream)
+            self._stream = None
+
+        self._cb = None
+        self._buffers = None
+        self.callback = None
+
+class FTDITransferStream(FTDIStream):
+    """An FTDIStream calling back once per completed transfer.
+
+    The transfers read into one bytearray owned by the stream, and libov
+    strips the FTDI headers in place, so callback(b, prog) gets a
+    memoryview of the payload rather than a copy. It's only valid until
+    the callback returns, when the transfer is resubmitted.
+    """
+    flags = FTDI_STREAM_COALESCE
+
+    def _make_buffers(self, size, count):
+        self._mem = bytearray(size * count)
+        self._view = memoryview(self._mem)
+
+        base = ctypes.addressof((ctypes.c_uint8 * len(self._mem)).from_buffer(self._mem))
+        self._base = base
+
+        return (ctypes.c_void_p * count)(*(base + i * size for i in range(count)))
+
+    def _make_callback(self):
+        def callback_wrapper(buf, ll, prog, user):
+            if ll:
+                off = buf - self._base
+                b = self._view[off:off + ll]
+            else:
+                b = b''
+            return self.callback(b, prog.contents if prog else None)
+
+        return p_cb_TransferCallback(callback_wrapper), None
+
+    def close(self):
+        super().close()
+
+        # The buffers can only be let go of once libov is done with them
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._view = None
+        self._mem = None
+
+class FTDIBatchStream(FTDIStream):
+    flags = FTDI_STREAM_COALESCE
+
+    def _make_callback(self):
+        def callback_wrapper(batch, prog, user):
+            return self.callback(batch.contents if batch else None,
+                    prog.contents if prog else None)
+
+        self._batch_cb = p_cb_BatchCallback(callback_wrapper)
+
+        self._framer = OVFramer_New(self._batch_cb, None)
+        if not self._framer:
+            raise MemoryError("Could not allocate framer")
+
+        return libov.OVFramer_StreamCallback, self._framer
+
+    # Times the framer lost sync, and the bytes it dropped getting it back
+    @property
+    def resyncs(self):
+        return OVFramer_GetResyncs(self._framer)
+
+    @property
+    def discarded(self):
+        return OVFramer_GetDiscarded(self._framer)
+
+    # Losses of sync at an IO response with a bad checksum
+    @property
+    def bad_checksums(self):
+        return OVFramer_GetBadChecksums(self._framer)
+
+    def close(self):
+        super().close()
+
+        if getattr(self, '_framer', None):
+            OVFramer_Free(self._framer)
+            self._framer = None
+
+        self._batch_cb = None
+
 def FPGA_GetConfigStatus(dev):
     return _FPGA_GetConfigStatus(dev._dev)
 
@@ -176,31 +469,116 @@ class TimeoutError(Exception):
     pass
 
 class _mapped_reg:
-    def __init__(self, readfn, writefn, name, addr):
+    """A register, read and written through readfn and writefn.
+
+    A cacheable register is one only the host changes (a CSRStorage): once
+    read or written its value is kept in shadow and rd() doesn't touch the
+    device again until invalidate(). Everything else is read every time.
+    """
+    def __init__(self, readfn, writefn, name, addr, cacheable=False):
         self.readfn = readfn
         self.writefn = writefn
+        self.name = name
         self.addr = addr
+        self.cacheable = cacheable
         self.shadow = 0
+        self.valid = False
+
+        # (address, shift) of each byte, in the order they're accessed
+        self.parts = ((addr, 0),)
 
     def rd(self):
-        self.shadow = self.readfn(self.addr)
+        if not self.valid:
+            self.shadow = self.readfn(self.addr)
+            self.valid = self.cacheable
+
+        return self.shadow
+
+    def wr(self, value):
+        self.writefn(self.addr, value)
+        self.shadow = value
+        self.valid = self.cacheable
+
+    def invalidate(self):
+        self.valid = False
+
+    def combine(self, values):
+        return sum(v << shift for v, (_, shift) in zip(values, self.parts))
+
+class _wide_reg(_mapped_reg):
+    """A register spread over several 8 bit CSRs.
+
+    batchfn is an IO.do_batch; all of the bytes are accessed in a single
+    batch, back to back and in parts order, so a value the gateware is
+    updating can't be torn across USB round trips.
+    """
+    def __init__(self, batchfn, name, parts, cacheable=False):
+        _mapped_reg.__init__(self, None, None, name, parts[0][0], cacheable)
+        self.batchfn = batchfn
+        self.parts = tuple(parts)
+
+    def rd(self):
+        if not self.valid:
+            self.shadow = self.combine(self.batchfn([(addr, None) for addr, _ in self.parts]))
+            self.valid = self.cacheable
+
         return self.shadow
 
     def wr(self, value):
-        self.shadow = self.writefn(self.addr, value)
+        self.batchfn([(addr, (value >> shift) & 0xFF) for addr, shift in self.parts])
+        self.shadow = value
+        self.valid = self.cacheable
 
 class _mapped_regs:
+    """Base of the register namespaces built by _regs_class(). Registers
+    are slots, so looking one up costs no more than any attribute; other
+    spellings of a name go through __getattr__."""
+    __slots__ = ['_d']
+
     def __init__(self, d):
         self._d = d
+        for name, reg in d.items():
+            for attr in self._reg_slots(name):
+                setattr(self, attr, reg)
+
+    @classmethod
+    def _reg_slots(cls, name):
+        return [attr for attr in set([name.upper(), name.lower()])
+                if not hasattr(_mapped_regs, attr)]
 
     def __getattr__(self, attr):
         try:
-            return self.__dict__['_d'][attr.upper()]
+            return self._d[attr.upper()]
         except KeyError:
             pass
 
         raise KeyError("No such register %s - did you specify a mapfile?" % attr)
 
+    def invalidate(self):
+        """Drop all cached values, eg. after the FPGA has been reloaded"""
+        for reg in self._d.values():
+            reg.invalidate()
+
+# Namespace classes by the key of the map they were built for
+_regs_classes = {}
+
+def _regs_class(key, names):
+    cls = _regs_classes.get(key)
+    if cls is None:
+        slots = []
+        for name in names:
+            slots += _mapped_regs._reg_slots(name)
+
+        cls = _regs_classes[key] = type("_regs_" + key, (_mapped_regs,),
+                {'__slots__': slots})
+
+    return cls
+
+# Parsed mapfiles - (addrmap, regattrs) - by the hash of their contents, so
+# a firmware package's map is only parsed once however many devices or
+# sessions use it
+_mapfiles = {}
+
 
 UCFG_REG_GO = 0x80
 UCFG_REG_ADDRMASK = 0x3F
@@ -267,30 +645,342 @@ SMSC_334x_MAP = {
 
 
 INCOMPLETE = -1
+
+# Returned by presentBytes when buf[start] isn't the start of a valid
+# message after all; the framer resynchronizes
+MISMATCH = -2
 UNMATCHED = 0
 class baseService:
+    # Magic bytes that start a message owned by this service. The framer
+    # indexes its dispatch table with these, so they must be unique among
+    # the registered services.
+    def getMagics(self):
+        return (self.MAGIC,)
+
     def matchMagic(self, byt):
-        return byt == self.MAGIC
+        return byt in self.getMagics()
 
     def getNeededSizeForMagic(self, byt):
         return self.NEEDED_FOR_SIZE
 
-    def presentBytes(self, b):
-        if not self.matchMagic(b[0]):
-            return UNMATCHED
-
-        if len(b) < self.getNeededSizeForMagic(b[0]):
+    # Called by the framer once buf[start] has been matched to one of our
+    # magics. buf is a memoryview over the framer's ring and valid data ends
+    # at buf[end]. consume() gets a view, not a copy - copy anything that
+    # must outlive the call.
+    def presentBytes(self, buf, start, end):
+        avail = end - start
+        if avail < self.getNeededSizeForMagic(buf[start]):
             return INCOMPLETE
 
-        size = self.getPacketSize(b)
+        size = self.getPacketSize(buf, start)
 
-        if len(b) < size:
+        if avail < size:
             return INCOMPLETE
 
-        self.consume(b[:size])
+        self.consume(buf[start:start + size])
 
         return size
 
+    # Called by the framer while resynchronizing, with buf[start] one of our
+    # magics. Returns the size of the message if the header looks valid, 0
+    # if it doesn't, or INCOMPLETE if more bytes are needed to tell.
+    def checkHeader(self, buf, start, end):
+        if end - start < self.getNeededSizeForMagic(buf[start]):
+            return INCOMPLETE
+
+        return self.getPacketSize(buf, start)
+
+class TransferQueue:
+    """Bounded handoff of raw stream data between two threads.
+
+    The reader (the libusb callback) only copies each chunk into one of
+    depth preallocated buffers; a separate decode thread takes them in
+    order, frames them and gives the buffers back. When every buffer is in
+    use the chunk is dropped and counted rather than stalling the reader.
+    """
+    __stats = collections.namedtuple('TransferQueue_Stat',
+            ['depth', 'queued', 'high_water', 'dropped', 'dropped_bytes'])
+
+    def __init__(self, depth=256, bufsize=4096):
+        self.depth = depth
+        self.bufs = [bytearray(bufsize) for _ in range(depth)]
+        self.free = collections.deque(range(depth))
+        self.full = queue.SimpleQueue()
+
+        self.reset()
+
+    def reset(self):
+        self.high_water = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    # Reader side
+    def put(self, b):
+        n = len(b)
+
+        try:
+            idx = self.free.popleft()
+        except IndexError:
+            self.dropped += 1
+            self.dropped_bytes += n
+            return False
+
+        buf = self.bufs[idx]
+        if n > len(buf):
+            buf = self.bufs[idx] = bytearray(n)
+
+        buf[:n] = b
+        self.full.put((idx, n))
+
+        queued = self.depth - len(self.free)
+        if queued > self.high_water:
+            self.high_water = queued
+
+        return True
+
+    # Decode side - returns (idx, view), or None on timeout. The view is only
+    # good until release(idx).
+    def get(self, timeout=None):
+        try:
+            idx, n = self.full.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        return idx, memoryview(self.bufs[idx])[:n]
+
+    def release(self, idx):
+        self.free.append(idx)
+
+    def stats(self):
+        return TransferQueue.__stats(depth=self.depth,
+                queued=self.depth - len(self.free), high_water=self.high_water,
+                dropped=self.dropped, dropped_bytes=self.dropped_bytes)
+
+def _column(typecode, ptr, n):
+    col = array.array(typecode)
+    col.frombytes(ctypes.string_at(ptr, n * col.itemsize))
+    return col
+
+class RingBuffer:
+    """Preallocated receive buffer with read and write cursors.
+
+    Data is appended at the write cursor and consumed from the read cursor.
+    Both cursors snap back to zero whenever the buffer drains, and the
+    unconsumed tail is only moved to the front when a write wouldn't fit, so
+    the cost of framing no longer depends on how much data is queued up.
+    """
+    def __init__(self, size=1 << 16):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.rd = 0
+        self.wr = 0
+
+    def __len__(self):
+        return self.wr - self.rd
+
+    def write(self, b):
+        n = len(b)
+        if self.wr + n > len(self.buf):
+            self.__make_room(n)
+
+        self.view[self.wr:self.wr + n] = b
+        self.wr += n
+
+    def consume(self, n):
+        self.rd += n
+        if self.rd == self.wr:
+            self.rd = self.wr = 0
+
+    def __make_room(self, n):
+        pending = self.wr - self.rd
+        size = len(self.buf)
+
+        if pending + n > size:
+            while pending + n > size:
+                size *= 2
+
+            # Consumers may still hold views of the old buffer, so don't
+            # resize in place
+            buf = bytearray(size)
+            buf[:pending] = self.view[self.rd:self.wr]
+            self.buf = buf
+            self.view = memoryview(buf)
+        else:
+            self.buf[:pending] = self.buf[self.rd:self.wr]
+
+        self.rd = 0
+        self.wr = pending
+
+class StreamFramer:
+    """Splits the FTDI byte stream into messages for a set of services.
+
+    The first byte of each message is looked up in a 256 entry table built
+    from the magics the registered services declare.
+    """
+    def __init__(self, services=(), bufsize=1 << 16):
+        self.services = []
+        self.dispatch = [None] * 256
+        self.ring = RingBuffer(bufsize)
+
+        self.resyncs = 0
+        self.discarded = 0
+
+        # Bytes dropped so far while out of sync, None while in sync
+        self.__lost = None
+        self.__find_magic = None
+
+        for service in services:
+            self.register(service)
+
+    def register(self, service):
+        magics = service.getMagics()
+
+        for magic in magics:
+            owner = self.dispatch[magic]
+            if owner is not None:
+                raise ValueError("Magic %02x already claimed by %s" %
+                        (magic, type(owner).__name__))
+
+        for magic in magics:
+            self.dispatch[magic] = service
+
+        self.services.append(service)
+
+        known = bytes(i for i in range(256) if self.dispatch[i] is not None)
+        self.__find_magic = re.compile(b"[" + re.escape(known) + b"]").search
+
+    def feed(self, b):
+        ring = self.ring
+        ring.write(b)
+
+        view = ring.view
+        dispatch = self.dispatch
+
+        while ring.rd != ring.wr:
+            if self.__lost is not None:
+                if not self.__resync(view):
+                    return
+                continue
+
+            service = dispatch[view[ring.rd]]
+            if service is None:
+                self.__lose_sync()
+                continue
+
+            code = service.presentBytes(view, ring.rd, ring.wr)
+            if code == INCOMPLETE:
+                return
+
+            if code == MISMATCH:
+                self.__lose_sync()
+                continue
+
+            ring.consume(code)
+
+    def __lose_sync(self):
+        self.resyncs += 1
+        self.__lost = 0
+
+    def __discard(self, n):
+        self.ring.consume(n)
+        self.discarded += n
+        self.__lost += n
+
+    # How many back to back messages with plausible headers it takes to
+    # believe we're back in sync
+    RESYNC_CONFIRM = 3
+
+    def __confirm(self, view, pos, end):
+        dispatch = self.dispatch
+
+        for i in range(self.RESYNC_CONFIRM):
+            service = dispatch[view[pos]]
+            if service is None:
+                return False
+
+            size = service.checkHeader(view, pos, end)
+            if size == 0:
+                return False
+
+            # Anything cut short is only good enough once it's been
+            # followed up by something else
+            if size == INCOMPLETE or pos + size > end:
+                return INCOMPLETE if i == 0 else True
+
+            pos += size
+            if pos == end:
+                return True
+
+        return True
+
+    # Skip to the next message that looks genuine: a known magic starting a
+    # run of messages whose headers their services are happy with. Returns
+    # False if more data is needed.
+    def __resync(self, view):
+        ring = self.ring
+        dispatch = self.dispatch
+        find_magic = self.__find_magic
+
+        pos = ring.rd
+        end = ring.wr
+
+        while True:
+            m = find_magic(view, pos, end) if find_magic else None
+            if m is None:
+                self.__discard(end - ring.rd)
+                return False
+
+            pos = m.start()
+            found = self.__confirm(view, pos, end)
+
+            if found == INCOMPLETE:
+                self.__discard(pos - ring.rd)
+                return False
+
+            if found:
+                break
+
+            pos += 1
+
+        self.__discard(pos - ring.rd)
+
+        print("Stream resynchronized - discarded %d bytes" % self.__lost)
+        self.__lost = None
+
+        return True
+
+    # Hand an OVPacketBatch from the native framer to the services
+    def feed_batch(self, batch):
+        n = batch.count
+        payload = ctypes.string_at(batch.payload, batch.payloadLength)
+        magic = ctypes.string_at(batch.magic, n)
+        offset = _column('I', batch.offset, n)
+        length = _column('H', batch.length, n)
+        flags = _column('H', batch.flags, n)
+        ts = _column('I', batch.ts, n)
+
+        dispatch = self.dispatch
+
+        # Common case - nothing but capture packets
+        if magic.count(0xA0) == n:
+            dispatch[0xA0].handle_batch(PacketBatch(payload, offset, length, flags, ts))
+            return
+
+        view = memoryview(payload)
+        capture = PacketBatch(payload)
+
+        for i, m in enumerate(magic):
+            if m == 0xA0:
+                capture.offset.append(offset[i])
+                capture.length.append(length[i])
+                capture.flags.append(flags[i])
+                capture.ts.append(ts[i])
+            else:
+                dispatch[m].consume(view[offset[i]:offset[i] + length[i]])
+
+        if len(capture):
+            dispatch[0xA0].handle_batch(capture)
+
 class IO:
     class __IOService(baseService):
         MAGIC = 0x55
@@ -299,50 +989,180 @@ class IO:
         def __init__(self):
             self.q = queue.Queue()
 
-        def getPacketSize(self, buf):
+            # If set, called as listener(addr, value) from the stream thread
+            # for each response, instead of queueing it for do_batch
+            self.listener = None
+
+            # Responses dropped for a bad checksum, see presentBytes
+            self.bad_checksums = 0
+
+        def getPacketSize(self, buf, start):
             return 5
 
+        def checkHeader(self, buf, start, end):
+            if end - start < 5:
+                return INCOMPLETE
+
+            if sum(buf[start:start + 4]) & 0xFF != buf[start + 4]:
+                return 0
+
+            return 5
+
+        # A bad checksum most likely means we've lost sync rather than that
+        # the device sent a bad response, so the framer resyncs. Either way
+        # the response is lost and its request will time out, so count them.
+        def presentBytes(self, buf, start, end):
+            size = self.checkHeader(buf, start, end)
+            if size == INCOMPLETE:
+                return INCOMPLETE
+
+            if not size:
+                self.bad_checksums += 1
+                return MISMATCH
+
+            self.consume(buf[start:start + size])
+
+            return size
+
+        # Only handed responses whose checksum has been checked, by
+        # presentBytes or the native framer
         def consume(self, buf):
             assert buf[0] == self.MAGIC
             assert len(buf) == 5
 
-            calc_ck = (sum(buf[0:4]) & 0xFF)
-
-            if calc_ck != buf[4]:
-                raise ProtocolError(
-                    "Checksum for response incorrect: expected %02x, got %02x" %
-                    (calc_ck, buf[4])
-                )
-
-            self.q.put((buf[1] << 8 | buf[2], buf[3]))
+            if self.listener is not None:
+                self.listener(buf[1] << 8 | buf[2], buf[3])
+            else:
+                self.q.put((buf[1] << 8 | buf[2], buf[3]))
 
     def __init__(self):
         self.service = IO.__IOService()
 
+        # Responses are matched up with requests through one queue, so
+        # only one transaction may be outstanding at a time
+        self.lock = threading.Lock()
+
+        # Posted writes not yet sent, and the echoes expected for those
+        # that have been
+        self.__posted = bytearray()
+        self.__posted_expect = []
+        self.__unacked = collections.deque()
+
+    @staticmethod
+    def encode(addr, value):
+        """Build the request for one access, value being None for a read.
+        Returns the address the response will echo, and the message."""
+        if value is None:
+            io_ext, value = addr, 0
+        else:
+            io_ext = 0x8000 | addr
+
+        req = [0x55, io_ext >> 8, io_ext & 0xFF, value]
+        req.append(sum(req) & 0xFF)
+
+        return io_ext, bytes(req)
+
     def do_read(self, addr, timeout=None):
-        return self.__txn(addr, 0, timeout)
+        return self.do_batch([(addr, None)], timeout)[0]
 
     def do_write(self, addr, value, timeout=None):
-        return self.__txn(0x8000 | addr, value, timeout)
+        return self.do_batch([(addr, value)], timeout)[0]
 
-    def __txn(self, io_ext, value, timeout):
-        msg = [0x55, (io_ext >> 8), io_ext & 0xFF, value]
-        checksum = (sum(msg) & 0xFF)
-        msg.append(checksum)
-        msg = bytes(msg)
+    def do_batch(self, ops, timeout=None):
+        """Perform several register accesses with a single USB write.
 
-        self.service.write(msg)
+        ops is a list of (addr, value) pairs, value being None for a read.
+        The CSR master handles requests in order, so they can all be sent
+        at once rather than waiting a round trip each. Returns the value
+        read or written for each op, in the same order.
+        """
+        msg = bytearray()
+        pending = {}
 
-        try:
-            resp = self.service.q.get(True, timeout)
-        except queue.Empty:
-            raise TimeoutError("IO access timed out")
+        for i, (addr, value) in enumerate(ops):
+            io_ext, req = IO.encode(addr, value)
+            msg += req
 
-        r_addr, r_value = resp
+            pending.setdefault(io_ext, collections.deque()).append(i)
 
-        assert r_addr == io_ext
+        results = [None] * len(ops)
 
-        return r_value
+        with self.lock:
+            # Any posted writes go first, and their echoes out of the way
+            self.__flush(timeout)
+
+            self.service.write(bytes(msg))
+
+            for _ in ops:
+                try:
+                    r_addr, r_value = self.service.q.get(True, timeout)
+                except queue.Empty:
+                    raise TimeoutError("IO access timed out")
+
+                slots = pending.get(r_addr)
+                if not slots:
+                    raise ProtocolError("Unexpected IO response for %04x" % r_addr)
+
+                results[slots.popleft()] = r_value
+
+        return results
+
+    def post(self, addr, value):
+        """Queue a write without waiting for it to complete.
+
+        Posted writes go out together, in order, as one asynchronous
+        transfer on the next send(), and their echoes are only checked by
+        flush(). Any other access flushes them first.
+        """
+        io_ext, req = IO.encode(addr, value)
+
+        with self.lock:
+            self.__posted += req
+            self.__posted_expect.append((io_ext, value))
+
+    def send(self):
+        """Send the queued posted writes, without waiting for them."""
+        with self.lock:
+            self.__send()
+
+    def flush(self, timeout=None):
+        """Send any queued posted writes and wait for all of their echoes.
+        Raises ProtocolError if one doesn't match what was written."""
+        with self.lock:
+            self.__flush(timeout)
+
+    def __send(self):
+        if not self.__posted:
+            return
+
+        err = self.service.write(bytes(self.__posted), async_=True)
+        if err:
+            raise IOError("IO write failed (%d)" % err)
+
+        self.__unacked.extend(self.__posted_expect)
+        self.__posted = bytearray()
+        self.__posted_expect = []
+
+    def __flush(self, timeout):
+        self.__send()
+
+        # Collect every echo even after a mismatch, so none are left behind
+        # for the next access
+        error = None
+        while self.__unacked:
+            try:
+                response = self.service.q.get(True, timeout)
+            except queue.Empty:
+                self.__unacked.clear()
+                raise TimeoutError("Posted write timed out")
+
+            expected = self.__unacked.popleft()
+            if response != expected and error is None:
+                error = ProtocolError("Posted write to %04x of %02x: got response %04x=%02x" % (
+                    expected[0] & 0x7FFF, expected[1], response[0], response[1]))
+
+        if error:
+            raise error
 
 # Basic Test service for testing stream rates and ordering
 # Ideally we'd verify the entire LFSR, but python is too slow
@@ -365,9 +1185,9 @@ class LFSRTest:
             self.error = 0
             self.total = 0
 
-        def getPacketSize(self, buf):
+        def getPacketSize(self, buf, start):
             # overhead is magic, length
-            return buf[1] + 2
+            return buf[start + 1] + 2
 
         def consume(self, buf):
             assert buf[0] == self.MAGIC
@@ -405,6 +1225,11 @@ HF0_FIRST = 0x10
 # Last packet of capture session; IE, when the cap hardware was disabled
 HF0_LAST = 0x20
 
+HF0_ALL = HF0_ERR | HF0_OVF | HF0_CLIP | HF0_TRUNC | HF0_FIRST | HF0_LAST
+
+# Largest capture packet the gateware emits (ovhw/whacker/producer.py)
+MAX_PACKET_SIZE = 800
+
 def decode_flags(flags):
     ret = ""
     ret += "Error " if flags & HF0_ERR else ""
@@ -415,16 +1240,332 @@ def decode_flags(flags):
     ret += "Last " if flags & HF0_LAST else ""
     return ret.rstrip()
 
+class PacketBatch:
+    """A run of capture packets framed in one pass.
+
+    The packet data is stored back to back in payload; packet i is
+    payload[offset[i]:offset[i] + length[i]] and its flags and 24 bit
+    timestamp are flags[i] and ts[i]. The columns are arrays, or
+    memoryviews of them for batches read from a PacketStore.
+    """
+    __slots__ = ['payload', 'offset', 'length', 'flags', 'ts']
+
+    def __init__(self, payload=b"", offset=None, length=None, flags=None, ts=None):
+        self.payload = payload
+        self.offset = offset if offset is not None else array.array('I')
+        self.length = length if length is not None else array.array('H')
+        self.flags = flags if flags is not None else array.array('H')
+        self.ts = ts if ts is not None else array.array('I')
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __iter__(self):
+        payload = self.payload
+        for off, l, flags, ts in zip(self.offset, self.length, self.flags, self.ts):
+            yield ts, payload[off:off + l], flags
+
+    def check_crc(self):
+        """CRC16 check of every DATA0/1/2 packet, in one call into libov.
+        Returns an array('B') with 0 for each packet whose CRC is wrong,
+        1 for the others."""
+        n = len(self)
+        result = array.array('B', bytes(n))
+        if n:
+            OV_CheckDataCRC(bytes(self.payload), _address(self.offset),
+                    _address(self.length), n, result.buffer_info()[0])
+
+        return result
+
+    def select(self, indices):
+        """A batch of just the given packets, sharing this one's payload."""
+        offset, length, flags, ts = self.offset, self.length, self.flags, self.ts
+
+        return PacketBatch(self.payload,
+                array.array('I', [offset[i] for i in indices]),
+                array.array('H', [length[i] for i in indices]),
+                array.array('H', [flags[i] for i in indices]),
+                array.array('I', [ts[i] for i in indices]))
+
+# Address of an array, or a memoryview of one, to pass to libov
+def _address(col):
+    if isinstance(col, array.array):
+        return col.buffer_info()[0]
+
+    return ctypes.addressof(ctypes.c_char.from_buffer(col))
+
+class StoredBatch(PacketBatch):
+    """PacketBatch read from a PacketStore, with its decoded columns: the
+    PID byte (0 for an empty packet), and the address and endpoint of a
+    complete token or SOF (0xFF for other packets)."""
+    __slots__ = ['pid', 'addr', 'endp']
+
+# Columns of a PacketStore segment, and their typecodes
+_STORE_COLUMNS = [('offset', 'I'), ('length', 'H'), ('flags', 'H'), ('ts', 'I'),
+        ('pid', 'B'), ('addr', 'B'), ('endp', 'B')]
+
+class _StoreSegment:
+    __slots__ = ['start', 'payload'] + [name for name, _ in _STORE_COLUMNS]
+
+    def __init__(self, start):
+        self.start = start
+        self.payload = bytearray()
+        for name, typecode in _STORE_COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.offset)
+
+    # Memory actually allocated, including the arrays' spare capacity and
+    # the objects themselves
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.payload) + \
+            sum(sys.getsizeof(getattr(self, name)) for name, _ in _STORE_COLUMNS)
+
+    def batch(self, a, b):
+        batch = StoredBatch(self.payload, memoryview(self.offset)[a:b],
+                memoryview(self.length)[a:b], memoryview(self.flags)[a:b],
+                memoryview(self.ts)[a:b])
+        batch.pid = memoryview(self.pid)[a:b]
+        batch.addr = memoryview(self.addr)[a:b]
+        batch.endp = memoryview(self.endp)[a:b]
+        return batch
+
+    # As batch(), but copying - the segment still being appended to can't
+    # have views taken of it
+    def copy(self, a, b):
+        base = self.offset[a]
+        end = self.offset[b - 1] + self.length[b - 1]
+
+        batch = StoredBatch(bytes(self.payload[base:end]),
+                array.array('I', [o - base for o in self.offset[a:b]]),
+                self.length[a:b], self.flags[a:b], self.ts[a:b])
+        batch.pid = self.pid[a:b]
+        batch.addr = self.addr[a:b]
+        batch.endp = self.endp[a:b]
+        return batch
+
+# PID bytes followed by an address and endpoint, or a frame number
+_HAS_TOKEN = [valid and (kind == PID_TOKEN or kind == PID_SOF)
+        for valid, _, kind in PID_TABLE]
+
+class PacketStore:
+    """Columnar store of capture packets, bounded in memory.
+
+    Packets are appended a PacketBatch at a time - the store is a capture
+    handler - and numbered from 0 in capture order. They're kept in
+    segments of about segment_bytes: the packet data back to back in one
+    bytes arena, and an array per column. Once more than max_bytes are
+    held, the oldest segments are evicted and first moves up.
+
+    A segment never changes once sealed, so batches() hands out
+    StoredBatches viewing the store's own memory rather than copies of it.
+    Only packets still in the segment being appended to are copied.
+
+    clear() starts numbering from 0 again and bumps generation, so readers
+    keeping their place by packet number can tell they need to start over.
+    """
+    __stats = collections.namedtuple('PacketStore_Stat',
+            ['packets', 'bytes', 'segments', 'evicted'])
+
+    def __init__(self, max_bytes=64 << 20, segment_bytes=1 << 20):
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+
+        # Appended to from the capture thread
+        self.lock = threading.Lock()
+
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+
+            # Sealed segments, oldest first, and the number of each one's
+            # first packet
+            self.__segments = []
+            self.__starts = []
+            self.__bytes = 0
+            self.__tail = _StoreSegment(0)
+            self.evicted = 0
+
+    def __first(self):
+        return self.__segments[0].start if self.__segments else self.__tail.start
+
+    @property
+    def first(self):
+        """Number of the oldest packet held"""
+        with self.lock:
+            return self.__first()
+
+    @property
+    def end(self):
+        """Number of the next packet to be appended"""
+        with self.lock:
+            return self.__tail.start + len(self.__tail)
+
+    def __len__(self):
+        with self.lock:
+            return self.__tail.start + len(self.__tail) - self.__first()
+
+    def handle_batch(self, batch):
+        payload = batch.payload
+        has_token = _HAS_TOKEN
+        token = TOKEN_TABLE
+
+        with self.lock:
+            tail = self.__tail
+            arena = tail.payload
+            offset, pid, addr, endp = tail.offset, tail.pid, tail.addr, tail.endp
+
+            for off, l in zip(batch.offset, batch.length):
+                offset.append(len(arena))
+
+                if not l:
+                    pid.append(0)
+                    addr.append(0xFF)
+                    endp.append(0xFF)
+                    continue
+
+                b = payload[off]
+                pid.append(b)
+                if l >= 3 and has_token[b]:
+                    a, e, _ = token[payload[off + 1] | payload[off + 2] << 8]
+                    addr.append(a)
+                    endp.append(e)
+                else:
+                    addr.append(0xFF)
+                    endp.append(0xFF)
+
+                arena += payload[off:off + l]
+
+            tail.length.extend(batch.length)
+            tail.flags.extend(batch.flags)
+            tail.ts.extend(batch.ts)
+
+            if tail.nbytes() >= self.segment_bytes:
+                self.__seal()
+
+    def append(self, ts, buf, flags):
+        """Append a single packet"""
+        self.handle_batch(PacketBatch(bytes(buf), array.array('I', [0]),
+            array.array('H', [len(buf)]), array.array('H', [flags]),
+            array.array('I', [ts])))
+
+    def __seal(self):
+        tail = self.__tail
+
+        tail.payload = bytes(tail.payload)
+        self.__segments.append(tail)
+        self.__starts.append(tail.start)
+        self.__bytes += tail.nbytes()
+        self.__tail = _StoreSegment(tail.start + len(tail))
+
+        # Views of evicted segments stay valid for as long as they're held
+        n = 0
+        while self.__bytes > self.max_bytes and n < len(self.__segments):
+            seg = self.__segments[n]
+            self.__bytes -= seg.nbytes()
+            self.evicted += len(seg)
+            n += 1
+
+        del self.__segments[:n]
+        del self.__starts[:n]
+
+    def batches(self, start=None, stop=None):
+        """StoredBatches holding packets start to stop, by default all of
+        them. Packets that have been evicted are left out."""
+        with self.lock:
+            tail = self.__tail
+            first = self.__first()
+            end = tail.start + len(tail)
+
+            start = first if start is None else max(start, first)
+            stop = end if stop is None else min(stop, end)
+            if start >= stop:
+                return
+
+            i = max(bisect.bisect_right(self.__starts, start) - 1, 0)
+            j = bisect.bisect_left(self.__starts, stop)
+            segments = self.__segments[i:j]
+
+            # The tail up to where it is now
+            last = None
+            if stop > tail.start:
+                last = tail.copy(max(start - tail.start, 0), stop - tail.start)
+
+        for seg in segments:
+            a = max(start - seg.start, 0)
+            b = min(stop - seg.start, len(seg))
+            if a < b:
+                yield seg.batch(a, b)
+
+        if last is not None:
+            yield last
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def stats(self):
+        with self.lock:
+            return PacketStore.__stats(
+                    packets=self.__tail.start + len(self.__tail) - self.__first(),
+                    bytes=self.__bytes + self.__tail.nbytes(),
+                    segments=len(self.__segments), evicted=self.evicted)
+
+_capture_hdr = struct.Struct("<xHHHB")
+
+def _capture_plausible(flags, size):
+    return size <= MAX_PACKET_SIZE and not flags & ~HF0_ALL
+
+def frame_capture(buf, start, end):
+    """Frame every complete capture packet in buf[start:end].
+
+    Scans consecutive 0xA0 packets (skipping the 2 byte 0xAC/0xAD messages
+    between them) and stops at the first incomplete packet or foreign magic.
+    Returns the PacketBatch and the number of bytes it covers; anything past
+    that is left for the next call.
+    """
+    offset = array.array('I')
+    length = array.array('H')
+    flags = array.array('H')
+    ts = array.array('I')
+
+    unpack = _capture_hdr.unpack_from
+    pos = start
+
+    while pos < end:
+        magic = buf[pos]
+        if magic == 0xA0:
+            if end - pos < 8:
+                break
+
+            f, size, ts_lo, ts_hi = unpack(buf, pos)
+            if not _capture_plausible(f, size) or end - pos < size + 8:
+                break
+
+            offset.append(pos + 8 - start)
+            length.append(size)
+            flags.append(f)
+            ts.append(ts_hi << 16 | ts_lo)
+
+            pos += size + 8
+        elif magic == 0xAC or magic == 0xAD:
+            if end - pos < 2:
+                break
+            pos += 2
+        else:
+            break
+
+    return PacketBatch(bytes(buf[start:pos]), offset, length, flags, ts), pos - start
+
 class RXCSniff:
     class __RXCSniffService(baseService):
         import crcmod
         data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
 
-        def getNeededSizeForMagic(self, b):
-            if b == 0xA0:
-                return 5
-            return 1
-
         def __init__(self):
             self.last_rxcmd = 0
 
@@ -434,43 +1575,87 @@ class RXCSniff:
 
             self.ui = USBInterpreter(self.highspeed)
 
-            self.handlers = [self.handle_usb_verbose]
+            # Either callables, called as handler(ts, buf, flags) for each
+            # packet, or objects with a handle_batch(batch) method that get
+            # a PacketBatch at a time. Both kinds can be mixed; each sees
+            # every packet of the capture session, in order.
+            self.handlers = [self.ui]
 
             self.got_start = False
 
+            self.packets = 0
 
-        def matchMagic(self, byt):
-            return byt == 0xAC or byt == 0xAD or byt == 0xA0
 
-        def getPacketSize(self, buf):
-            if buf[0] != 0xA0:
-                return 2
-            else:
-                #print("SIZING: %s" % " ".join("%02x" %i for i in buf))
-                return (buf[4] << 8 | buf[3]) + 8
+        def getMagics(self):
+            return (0xA0, 0xAC, 0xAD)
 
+        # Rather than one message at a time, take every complete capture
+        # packet that's already buffered
+        def presentBytes(self, buf, start, end):
+            batch, size = frame_capture(buf, start, end)
 
-        def consume(self, buf):
-            if buf[0] == 0xA0:
-                flags = buf[1] | buf[2] << 8
+            if not size:
+                return MISMATCH if self.checkHeader(buf, start, end) == 0 else INCOMPLETE
 
-                ts = buf[5] | buf[6] << 8 | buf[7] << 16
+            self.handle_batch(batch)
 
-                if flags != 0 and flags != HF0_FIRST and flags != HF0_LAST:
-                    print("PERR: %04X (%s)" % (flags, decode_flags(flags)))
-               
-                if flags & HF0_FIRST:
-                    self.got_start = True
+            return size
 
-                if self.got_start:
-                    self.handle_usb(ts, buf[8:], flags)
+        def checkHeader(self, buf, start, end):
+            if buf[start] != 0xA0:
+                return 2 if end - start >= 2 else INCOMPLETE
 
-                if flags & HF0_LAST:
-                    self.got_start = False
+            if end - start < 8:
+                return INCOMPLETE
 
-        def handle_usb(self, ts, buf, flags):
+            f, size, _, _ = _capture_hdr.unpack_from(buf, start)
+            return size + 8 if _capture_plausible(f, size) else 0
+
+        def handle_batch(self, batch):
+            self.packets += len(batch)
+
+            # Common case - mid session, and nothing to report
+            if not (self.got_start and not any(batch.flags)):
+                keep = []
+
+                for i, flags in enumerate(batch.flags):
+                    if flags != 0 and flags != HF0_FIRST and flags != HF0_LAST:
+                        print("PERR: %04X (%s)" % (flags, decode_flags(flags)))
+
+                    if flags & HF0_FIRST:
+                        self.got_start = True
+
+                    if self.got_start:
+                        keep.append(i)
+
+                    if flags & HF0_LAST:
+                        self.got_start = False
+
+                if len(keep) != len(batch):
+                    batch = batch.select(keep)
+
+            if len(batch):
+                self.deliver(batch)
+
+        # Hand a batch to every handler, bypassing the session tracking
+        def deliver(self, batch):
+            per_packet = []
             for handler in self.handlers:
-                handler(ts, buf, flags)
+                if hasattr(handler, 'handle_batch'):
+                    handler.handle_batch(batch)
+                else:
+                    per_packet.append(handler)
+
+            if per_packet:
+                for ts, buf, flags in batch:
+                    for handler in per_packet:
+                        handler(ts, buf, flags)
+
+        # A single packet, for callers that produce them one at a time
+        def handle_usb(self, ts, buf, flags):
+            self.deliver(PacketBatch(bytes(buf), array.array('I', [0]),
+                array.array('H', [len(buf)]), array.array('H', [flags]),
+                array.array('I', [ts])))
 
         def handle_usb_verbose(self, ts, buf, flags):
 #                ChandlePacket(ts, flags, buf, len(buf))
@@ -480,85 +1665,277 @@ class RXCSniff:
     def __init__(self):
         self.service = RXCSniff.__RXCSniffService()
 
+# Per-host settings, such as the stream geometry found by "ovctl tune-stream"
+HOST_CONFIG = os.path.join(
+        os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'),
+        'openvizsla', 'host.ini')
+
+# (packetsPerTransfer, numTransfers) when the host hasn't been tuned
+DEFAULT_STREAM_GEOMETRY = (8, 16)
+
+def load_stream_geometry(path=HOST_CONFIG):
+    cfg = configparser.ConfigParser()
+    cfg.read(path)
+
+    try:
+        return (cfg.getint('stream', 'packets_per_transfer'),
+                cfg.getint('stream', 'num_transfers'))
+    except (configparser.Error, ValueError):
+        return DEFAULT_STREAM_GEOMETRY
+
+def save_stream_geometry(geometry, path=HOST_CONFIG):
+    cfg = configparser.ConfigParser()
+    cfg.read(path)
+
+    if not cfg.has_section('stream'):
+        cfg.add_section('stream')
+
+    packetsPerTransfer, numTransfers = geometry
+    cfg.set('stream', 'packets_per_transfer', str(packetsPerTransfer))
+    cfg.set('stream', 'num_transfers', str(numTransfers))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        cfg.write(f)
+
+# Registers that are read only, or that clear when read
+SMSC_334x_READONLY = frozenset(["VIDL", "VIDH", "PIDL", "PIDH",
+    "USB_INT_STAT", "USB_INT_LATCH", "DEBUG",
+    "CARKIT_INT_STAT", "CARKIT_INT_LATCH"])
+
+# What ulpi_snapshot() reads: every register bar the latches, whose reads
+# have side effects, and the _SET/_CLR aliases
+SMSC_334x_SNAPSHOT = [name for name in sorted(SMSC_334x_MAP, key=SMSC_334x_MAP.get)
+        if not name.endswith(("_SET", "_CLR", "_LATCH"))]
+
 class OVDevice:
-    def __init__(self, mapfile=None, verbose=False):
+    __stats = collections.namedtuple('OVDevice_Stat',
+            ['bytes_per_sec', 'avg_bytes_per_sec', 'total_bytes',
+             'packets_per_sec', 'total_packets', 'transfers_in_flight',
+             'resyncs', 'discarded_bytes', 'bad_checksums'])
+
+    # native_framing moves stream framing into libov; only the built in
+    # IO, LFSR test and capture messages are understood in that mode.
+    #
+    # queue_depth hands the raw stream to a separate decode thread through
+    # a TransferQueue of that many buffers, so slow handlers can't hold up
+    # resubmitting transfers.
+    #
+    # stream_geometry is (packetsPerTransfer, numTransfers); if not given,
+    # open() loads this host's from HOST_CONFIG.
+    def __init__(self, mapfile=None, verbose=False, native_framing=False,
+            queue_depth=None, stream_geometry=None):
         self.__is_open = False
 
+        self.stream_geometry = stream_geometry
+        self.__stream_restart = False
+
         self.dev = FTDIDevice()
         self.verbose = verbose
+        self.native_framing = native_framing
+
+        if queue_depth and native_framing:
+            raise ValueError("queue_depth can't be used with native_framing")
+
+        self.stream_queue = TransferQueue(queue_depth) if queue_depth else None
 
         self.__addrmap = {}
 
-        if mapfile:
-            self.__parse_mapfile(mapfile)
+        # Per register key=value attributes from the mapfile
+        self.__regattrs = {}
 
+        mapkey = "none"
+        if mapfile:
+            mapkey = self.__parse_mapfile(mapfile)
 
-        self.regs = self.__build_map(self.__addrmap, self.ioread, self.iowrite)
-        self.ulpiregs = self.__build_map(SMSC_334x_MAP, self.ulpiread, self.ulpiwrite)
+        self.regs = self.__build_map(mapkey, self.__addrmap, self.__rd, self.__wr,
+                self.iobatch, self.__regattrs)
+        self.ulpiregs = self.__build_map("SMSC_334x", SMSC_334x_MAP,
+                self.ulpiread, self.ulpiwrite)
 
 
         self.clkup = False
 
+        # Last known PHY register values, see ulpi_snapshot()
+        self.ulpi_state = None
+
+        # Nesting depth of posted() blocks
+        self.__posting = 0
 
         self.io = IO()
         self.lfsrtest = LFSRTest()
         self.rxcsniff = RXCSniff()
 
-        self.__services = [self.io.service, self.lfsrtest.service, self.rxcsniff.service]
+        self.__framer = StreamFramer()
+
+        self.__stat = OVDevice.__stats(0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.__stat_packets = 0
+
+        for service in [self.io.service, self.lfsrtest.service, self.rxcsniff.service]:
+            self.register_service(service)
 
-        # Inject a write function to the services
-        for service in self.__services:
-            def write(msg):
-                if self.verbose:
-                    print("< %s" % " ".join("%02x" % i for i in msg))
+    def register_service(self, service):
+        """Attach a stream service to the device.
 
-                self.dev.write(FTDI_INTERFACE_A, msg, async=False)
+        The service receives every message starting with one of its
+        getMagics() bytes, and gets a write function for its requests.
+        """
+        self.__framer.register(service)
 
-            service.write = write
+        # Inject a write function to the service
+        def write(msg, async_=False):
+            if self.verbose:
+                print("< %s" % " ".join("%02x" % i for i in msg))
+
+            return self.dev.write(FTDI_INTERFACE_A, msg, async_=async_)
+
+        service.write = write
     
+    def set_stream_geometry(self, packetsPerTransfer, numTransfers):
+        """Change the transfer geometry of the running stream. Data in
+        flight when the stream is switched over is lost."""
+        self.stream_geometry = (packetsPerTransfer, numTransfers)
+        self.__stream_restart = True
+
+    def stats(self):
+        """Link throughput as of the stream's last progress update, which
+        libov makes every 100ms."""
+        return self.__stat
+
+    def __update_stats(self, prog, resyncs, discarded, bad_checksums):
+        packets = self.rxcsniff.service.packets
+
+        packets_per_sec = 0
+        if prog.prev.time.tv_sec:
+            interval = float(prog.current.time) - float(prog.prev.time)
+            if interval > 0:
+                packets_per_sec = (packets - self.__stat_packets) / interval
+
+        self.__stat_packets = packets
+
+        self.__stat = OVDevice.__stats(
+                bytes_per_sec=prog.currentRate,
+                avg_bytes_per_sec=prog.totalRate,
+                total_bytes=prog.current.totalBytes,
+                packets_per_sec=packets_per_sec,
+                total_packets=packets,
+                transfers_in_flight=prog.transfersInFlight,
+                resyncs=resyncs,
+                discarded_bytes=discarded,
+                bad_checksums=bad_checksums)
+
     def __comms(self):
-        self.__buf = b""
+        framer = self.__framer
+        stream_queue = self.stream_queue
 
         def callback(b, prog):
             try:
+                if prog:
+                    self.__update_stats(prog, framer.resyncs, framer.discarded,
+                            self.io.service.bad_checksums)
+
                 if self.verbose and b:
                     print("> %s" % " ".join("%02x" % i for i in b))
 
-                self.__buf += b
+                if stream_queue is None:
+                    framer.feed(b)
+                elif b:
+                    stream_queue.put(b)
 
-                incomplete = False
+                return int(self.__comm_term or self.__stream_restart)
+            except Exception as e:
+                self.__comm_term = True
+                self.__comm_exc = e
+                return 1
+
+        def batch_callback(batch, prog):
+            try:
+                if prog:
+                    self.__update_stats(prog, stream.resyncs, stream.discarded,
+                            stream.bad_checksums)
 
-                while self.__buf and not incomplete:
-                    for service in self.__services:
-                        code = service.presentBytes(self.__buf)
-                        if code == INCOMPLETE:
-                            incomplete = True
-                            break
-                        elif code:
-                            self.__buf = self.__buf[code:]
-                            break
-                    else:
-                        print("Unmatched byte %02x - discarding" % self.__buf[0])
-                        self.__buf = self.__buf[1:]
+                if batch:
+                    framer.feed_batch(batch)
 
-                return int(self.__comm_term) 
+                return int(self.__comm_term or self.__stream_restart)
             except Exception as e:
                 self.__comm_term = True
                 self.__comm_exc = e
                 return 1
 
         while not self.__comm_term:
-            self.dev.read_async(FTDI_INTERFACE_A, callback, 8, 16)
+            self.__stream_restart = False
+            packetsPerTransfer, numTransfers = self.stream_geometry
+
+            # One stream per geometry: its transfers are reused each time
+            # the read loop has to be restarted
+            if self.native_framing:
+                stream = self.dev.batch_stream(FTDI_INTERFACE_A, batch_callback,
+                        packetsPerTransfer, numTransfers)
+            else:
+                stream = self.dev.transfer_stream(FTDI_INTERFACE_A, callback,
+                        packetsPerTransfer, numTransfers)
+
+            with stream:
+                while not (self.__comm_term or self.__stream_restart):
+                    stream.run()
 
         if self.__comm_exc:
             raise self.__comm_exc
             
-    def __build_map(self, addrmap, readfn, writefn):
+    def __decode(self):
+        framer = self.__framer
+        stream_queue = self.stream_queue
+
+        try:
+            while not self.__comm_term:
+                item = stream_queue.get(timeout=0.1)
+                if item is None:
+                    continue
+
+                idx, view = item
+                try:
+                    framer.feed(view)
+                finally:
+                    view.release()
+                    stream_queue.release(idx)
+        except Exception as e:
+            self.__comm_term = True
+            self.__comm_exc = e
+            raise
+
+    # Wide registers are only built if batchfn is given
+    def __build_map(self, key, addrmap, readfn, writefn, batchfn=None, regattrs={}):
         d = {}
         for name, addr in addrmap.items():
-            d[name] = _mapped_reg(readfn, writefn, name, addr)
+            attrs = regattrs.get(name, {})
+            cacheable = attrs.get('kind') == 'storage'
+            width = int(attrs.get('width', 8))
+
+            if width > 8 and batchfn:
+                # Most significant byte first
+                nr = (width + 7) // 8
+                parts = [(addr + i, 8 * (nr - 1 - i)) for i in range(nr)]
+                d[name] = _wide_reg(batchfn, name, parts, cacheable)
+            else:
+                d[name] = _mapped_reg(readfn, writefn, name, addr, cacheable)
+
+        # Gateware that predates wide CSRs splits values into X_LO and X_HI
+        # registers; present those as X as well
+        for name in list(d):
+            if not batchfn or not name.endswith("_LO"):
+                continue
 
-        return _mapped_regs(d)
+            base = name[:-3]
+            lo, hi = d[name], d.get(base + "_HI")
+            if hi is None or base in d:
+                continue
+
+            parts = sorted([(lo.addr, 0), (hi.addr, 8)])
+            d[base] = _wide_reg(batchfn, base, parts,
+                    lo.cacheable and hi.cacheable)
+
+        return _regs_class(key, d)(d)
 
 
     def __check_clkup(self):
@@ -571,38 +1948,53 @@ class OVDevice:
 
 
     def __parse_mapfile(self, mapfile):
+        data = mapfile.read()
+        key = hashlib.sha1(data).hexdigest()
 
-        for line in mapfile.readlines():
-            line = line.strip().decode('utf-8')
+        if key not in _mapfiles:
+            addrmap = {}
+            regattrs = {}
 
-            line = re.sub('#.*', '', line)
-            if not line:
-                continue
+            for line in data.decode('utf-8').splitlines():
+                line = re.sub('#.*', '', line.strip())
+                if not line:
+                    continue
+
+                # NAME = addr, optionally followed by key=value attributes
+                m = re.match(r'\s*(\w+)\s*=\s*(\w+)((?:\s+\w+=\w+)*)\s*$', line)
+                if not m:
+                    raise ValueError("Mapfile - could not parse %s" % line)
+
+                name = m.group(1)
+                value = int(m.group(2), 16)
 
-            m = re.match('\s*(\w+)\s*=\s*(\w+)\s*', line)
-            if not m:
-                raise ValueError("Mapfile - could not parse %s" % line)
+                addrmap[name] = value
+                regattrs[name] = dict(a.split('=') for a in m.group(3).split())
 
-            name = m.group(1)
-            value = int(m.group(2), 16)
+            _mapfiles[key] = (addrmap, regattrs)
 
-            self.__addrmap[name] = value
+        addrmap, regattrs = _mapfiles[key]
+        self.__addrmap.update(addrmap)
+        self.__regattrs.update(regattrs)
 
+        return key
 
     def resolve_addr(self, sym):
         if type(sym) == int:
             return sym
 
+        # A name that's also valid hex is taken as a number, as it always has
         try:
             return int(sym, 16)
         except ValueError:
             pass
 
-        try:
-            return self.__addrmap[sym.upper()]
-        except KeyError:
+        addr = self.__addrmap.get(sym.upper())
+        if addr is None:
             raise ValueError("No map for %s" % sym)
 
+        return addr
+
     def __del__(self):
         if self.__is_open:
             self.close()
@@ -655,12 +2047,24 @@ class OVDevice:
             raise TypeError("bitstream must be bytes or file-like")
         
     
+        # Whatever was cached may be stale, even if the FPGA wasn't reloaded:
+        # another program may have used the device since
+        self.regs.invalidate()
+        self.ulpi_state = None
+
+        if self.stream_geometry is None:
+            self.stream_geometry = load_stream_geometry()
+
         self.commthread = threading.Thread(target=self.__comms, daemon=True)
         self.__comm_term = False
         self.__comm_exc = None
 
         self.commthread.start()
 
+        if self.stream_queue is not None:
+            self.decodethread = threading.Thread(target=self.__decode, daemon=True)
+            self.decodethread.start()
+
         self.__comm_term = False
         self.__is_open = True
 
@@ -671,39 +2075,219 @@ class OVDevice:
         self.__comm_term = True
         self.commthread.join()
 
+        if self.stream_queue is not None:
+            self.decodethread.join()
+
         self.dev.close()
 
         self.__is_open = False
 
 
-    def ulpiread(self, addr):
+    # The ULPI command registers start a PHY transaction when written with
+    # UCFG_REG_GO, and hold GO until it's done. Polling for that costs a USB
+    # round trip per check, so the paths below instead send each access's
+    # command, GO check and data access back to back in one IO batch. PHY
+    # register accesses finish far quicker than our IO requests arrive.
+    #
+    # The gateware feeds the PHY straight from the CSRs though, so an access
+    # that's still busy when the next one goes out may be disturbed by it.
+    # That's harmless for reads, which are simply redone the slow way from
+    # the busy one on. A disturbed write could land in the wrong register,
+    # which can't be undone, so each write is confirmed done before the next
+    # is sent.
+
+    def __ulpi_wait(self, cmdreg):
+        while cmdreg.rd() & UCFG_REG_GO:
+            pass
+
+    def ulpiread_polled(self, addr):
+        """Read a ULPI register one step at a time, polling for completion.
+        Kept as the fallback for ulpiread_batch, and for comparison."""
         assert self.__check_clkup()
 
         self.regs.ucfg_rcmd.wr(UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK))
-
-        while self.regs.ucfg_rcmd.rd() & UCFG_REG_GO:
-            pass
+        self.__ulpi_wait(self.regs.ucfg_rcmd)
 
         return self.regs.ucfg_rdata.rd()
 
-
-    def ulpiwrite(self, addr, value):
+    def ulpiwrite_polled(self, addr, value):
+        """Write a ULPI register one step at a time, polling for completion."""
         assert self.__check_clkup()
 
         self.regs.ucfg_wdata.wr(value)
         self.regs.ucfg_wcmd.wr(UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK))
-        
-        while self.regs.ucfg_wcmd.rd() & UCFG_REG_GO:
-            pass
+        self.__ulpi_wait(self.regs.ucfg_wcmd)
 
-    def ioread(self, addr):
-        return self.io.do_read(self.resolve_addr(addr))
+        self.__ulpi_track([(addr, value)])
 
-    def iowrite(self, addr, value):
-        return self.io.do_write(self.resolve_addr(addr), value)
+    def ulpiread(self, addr):
+        return self.ulpiread_batch([addr])[0]
+
+    def ulpiwrite(self, addr, value):
+        self.ulpiwrite_batch([(addr, value)])
+
+    def ulpiread_batch(self, addrs):
+        """Read several ULPI registers with one IO batch."""
+        assert self.__check_clkup()
+
+        rcmd = self.regs.ucfg_rcmd.addr
+        rdata = self.regs.ucfg_rdata.addr
+
+        ops = []
+        for addr in addrs:
+            ops += [(rcmd, UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK)),
+                    (rcmd, None),
+                    (rdata, None)]
+
+        results = self.io.do_batch(ops)
+
+        values = []
+        for i, addr in enumerate(addrs):
+            _, status, value = results[3 * i:3 * i + 3]
+            if status & UCFG_REG_GO:
+                self.__ulpi_wait(self.regs.ucfg_rcmd)
+                values += [self.ulpiread_polled(a) for a in addrs[i:]]
+                break
 
+            values.append(value)
 
+        return values
 
+    def ulpiwrite_batch(self, writes):
+        """Write several ULPI registers, one IO batch each. writes is a
+        list of (addr, value) pairs, written in order."""
+        assert self.__check_clkup()
+
+        wcmd = self.regs.ucfg_wcmd.addr
+        wdata = self.regs.ucfg_wdata.addr
+
+        try:
+            for addr, value in writes:
+                _, _, status = self.io.do_batch([
+                    (wdata, value),
+                    (wcmd, UCFG_REG_GO | (addr & UCFG_REG_ADDRMASK)),
+                    (wcmd, None)])
+
+                if status & UCFG_REG_GO:
+                    self.__ulpi_wait(self.regs.ucfg_wcmd)
+
+                self.__ulpi_track([(addr, value)])
+        finally:
+            # Written behind its back
+            self.regs.ucfg_wdata.invalidate()
+
+    def __ulpi_track(self, writes):
+        if self.ulpi_state is None:
+            return
+
+        names = dict((SMSC_334x_MAP[name], name) for name in self.ulpi_state)
+
+        for addr, value in writes:
+            name = names.get(addr & UCFG_REG_ADDRMASK)
+            if name is None:
+                # A _SET/_CLR alias or unmapped register - we can no longer
+                # tell what the PHY holds
+                self.ulpi_state = None
+                return
+
+            self.ulpi_state[name] = value
+
+    def ulpi_snapshot(self):
+        """Read the PHY's registers (SMSC_334x_SNAPSHOT) in one batch.
 
+        Returns a dict of register name to value. The snapshot also becomes
+        the cached PHY state that ulpi_restore() compares against; ULPI
+        writes keep it up to date. Bits the PHY changes by itself, such as
+        FUNC_CTL's self clearing RESET, aren't tracked.
+        """
+        values = self.ulpiread_batch([SMSC_334x_MAP[name] for name in SMSC_334x_SNAPSHOT])
+        self.ulpi_state = dict(zip(SMSC_334x_SNAPSHOT, values))
 
+        return dict(self.ulpi_state)
 
+    def ulpi_restore(self, snapshot):
+        """Write back the registers of snapshot that differ from the cached
+        PHY state. Read only registers are skipped. A fresh snapshot is
+        taken first if there's no cached state. Returns the names of the
+        registers written."""
+        if self.ulpi_state is None:
+            self.ulpi_snapshot()
+
+        names = [name for name in SMSC_334x_SNAPSHOT
+                if name in snapshot and name not in SMSC_334x_READONLY
+                and snapshot[name] != self.ulpi_state[name]]
+
+        if names:
+            self.ulpiwrite_batch([(SMSC_334x_MAP[name], snapshot[name]) for name in names])
+
+        return names
+
+    # regs' accessors, which are always given a numeric address
+    def __rd(self, addr):
+        return self.io.do_read(addr)
+
+    def __wr(self, addr, value):
+        if self.__posting:
+            self.io.post(addr, value)
+            return value
+
+        return self.io.do_write(addr, value)
+
+    def ioread(self, addr):
+        return self.__rd(self.resolve_addr(addr))
+
+    def iowrite(self, addr, value):
+        return self.__wr(self.resolve_addr(addr), value)
+
+    def read_regs(self, *names):
+        """Read several registers, wide ones included, in one IO batch.
+        Returns a dict of name to value; the cache is bypassed."""
+        regs = [getattr(self.regs, name) for name in names]
+
+        ops = []
+        for reg in regs:
+            ops += [(addr, None) for addr, _ in reg.parts]
+
+        results = self.io.do_batch(ops)
+
+        values = {}
+        pos = 0
+        for name, reg in zip(names, regs):
+            n = len(reg.parts)
+            values[name] = reg.combine(results[pos:pos + n])
+            pos += n
+
+        return values
+
+    def iobatch(self, ops):
+        """ioread/iowrite several registers at once - see IO.do_batch.
+        Addresses may be register names."""
+        ops = [(self.resolve_addr(addr), value) for addr, value in ops]
+
+        if self.__posting and all(value is not None for _, value in ops):
+            for addr, value in ops:
+                self.io.post(addr, value)
+            return [value for _, value in ops]
+
+        return self.io.do_batch(ops)
+
+    @contextlib.contextmanager
+    def posted(self):
+        """Post register writes made within the block.
+
+        The writes are queued and, at the end of the block, sent as one
+        asynchronous transfer without waiting for their echoes. Call
+        flush() to check them; any later read or unposted write does so
+        too, first.
+        """
+        self.__posting += 1
+        try:
+            yield
+        finally:
+            self.__posting -= 1
+            if not self.__posting:
+                self.io.send()
+
+    def flush(self, timeout=None):
+        """Wait for every posted write to complete - see IO.flush"""
+        self.io.flush(timeout)
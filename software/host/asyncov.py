@@ -0,0 +1,217 @@
+# asyncio front-end for OVDevice
+#
+# OVDevice's register accesses block the calling thread for a USB round trip
+# each, so driving several devices at once has meant a thread per device.
+# AsyncOVDevice makes them awaitable instead: requests go out with
+# non-blocking writes, any number may be outstanding, and each is resolved
+# when the stream thread sees the response echoing its address. Captured
+# packets are available as an async iterator over PacketBatches.
+#
+#     async def monitor(dev):
+#         await dev.open()
+#         print(hex(await dev.ioread("ucfg_stat")))
+#         async for batch in dev.packets():
+#             ...
+#
+# The device still has its own stream thread; everything here runs on the
+# event loop, and the wrapper must be created on it (from a coroutine) or
+# be given the loop.
+
+import asyncio
+import collections
+
+import LibOV
+
+class _BatchSink:
+    """Capture handler passing PacketBatches from the stream thread to the
+    event loop. At most depth batches are held; batches arriving while it's
+    full are dropped and counted."""
+
+    def __init__(self, loop, depth):
+        self.loop = loop
+        self.depth = depth
+        self.batches = collections.deque()
+        self.dropped = 0
+        self.closed = False
+        self.waiter = None
+
+    # Stream thread
+    def handle_batch(self, batch):
+        if len(self.batches) >= self.depth:
+            self.dropped += len(batch)
+            return
+
+        self.batches.append(batch)
+        self.loop.call_soon_threadsafe(self.wake)
+
+    # Event loop
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.batches:
+            if self.closed:
+                raise StopAsyncIteration
+
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+        return self.batches.popleft()
+
+class AsyncOVDevice:
+    """Wraps an OVDevice for use from an asyncio event loop.
+
+    The wrapper takes over the device's IO responses and capture handlers,
+    so the OVDevice's own blocking register accessors mustn't be used
+    alongside it. Add further capture handlers to
+    dev.rxcsniff.service.handlers if needed.
+    """
+
+    def __init__(self, dev, loop=None, queue_depth=256):
+        self.dev = dev
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+
+        # ULPI accesses all go through the same few registers, so only one
+        # may be in progress
+        self.__ulpi_lock = asyncio.Lock()
+
+        # Futures waiting on each echoed address, oldest first
+        self.__pending = collections.defaultdict(collections.deque)
+
+        self.__sink = _BatchSink(self.loop, queue_depth)
+
+        dev.io.service.listener = self.__on_response
+        dev.rxcsniff.service.handlers = [self.__sink]
+
+    async def open(self, bitstream=None):
+        # Configuring the FPGA takes a while, so keep it off the loop
+        err = await self.loop.run_in_executor(None, self.dev.open, bitstream)
+        if err:
+            raise IOError("Could not open device (%d)" % err)
+
+    async def close(self):
+        self.dev.io.service.listener = None
+        self.__sink.close()
+        await self.loop.run_in_executor(None, self.dev.close)
+
+        for waiting in self.__pending.values():
+            for fut in waiting:
+                fut.cancel()
+
+        self.__pending.clear()
+
+    @property
+    def dropped(self):
+        """Captured packets dropped because packets() wasn't keeping up."""
+        return self.__sink.dropped
+
+    # Called on the stream thread
+    def __on_response(self, addr, value):
+        self.loop.call_soon_threadsafe(self.__resolve, addr, value)
+
+    def __resolve(self, addr, value):
+        waiting = self.__pending.get(addr)
+        if not waiting:
+            print("Unexpected IO response for %04x" % addr)
+            return
+
+        fut = waiting.popleft()
+        if not fut.done():
+            fut.set_result(value)
+
+    def __submit(self, ops):
+        msg = bytearray()
+        futs = []
+        waits = []
+
+        for addr, value in ops:
+            io_ext, req = LibOV.IO.encode(self.dev.resolve_addr(addr), value)
+            msg += req
+
+            fut = self.loop.create_future()
+            self.__pending[io_ext].append(fut)
+            futs.append(fut)
+            waits.append((io_ext, fut))
+
+        # Responses are resolved on the loop, so none can be handled before
+        # their futures are in place
+        err = self.dev.io.service.write(bytes(msg), async_=True)
+        if err:
+            self.__abandon(waits)
+            raise IOError("IO write failed (%d)" % err)
+
+        return futs, waits
+
+    def __abandon(self, waits):
+        # Responses are matched to futures by order, so a future left queued
+        # after its request is given up on would take the next response for
+        # its address, and every one after would go to the request before.
+        for io_ext, fut in waits:
+            fut.cancel()
+
+            waiting = self.__pending.get(io_ext)
+            if waiting and fut in waiting:
+                waiting.remove(fut)
+
+    async def iobatch(self, ops, timeout=None):
+        """Like OVDevice.iobatch: ops is a list of (addr, value) pairs,
+        value being None for a read."""
+        futs, waits = self.__submit(ops)
+
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futs), timeout)
+        except asyncio.TimeoutError:
+            raise LibOV.TimeoutError("IO access timed out")
+        finally:
+            # No-op once every response has arrived
+            self.__abandon(waits)
+
+    async def ioread(self, addr, timeout=None):
+        return (await self.iobatch([(addr, None)], timeout))[0]
+
+    async def iowrite(self, addr, value, timeout=None):
+        return (await self.iobatch([(addr, value)], timeout))[0]
+
+    async def ulpiread(self, addr):
+        regs = self.dev.regs
+
+        async with self.__ulpi_lock:
+            _, status, value = await self.iobatch([
+                (regs.ucfg_rcmd.addr, LibOV.UCFG_REG_GO | (addr & LibOV.UCFG_REG_ADDRMASK)),
+                (regs.ucfg_rcmd.addr, None),
+                (regs.ucfg_rdata.addr, None)])
+
+            while status & LibOV.UCFG_REG_GO:
+                status, value = await self.iobatch([
+                    (regs.ucfg_rcmd.addr, None),
+                    (regs.ucfg_rdata.addr, None)])
+
+        return value
+
+    async def ulpiwrite(self, addr, value):
+        regs = self.dev.regs
+
+        async with self.__ulpi_lock:
+            _, _, status = await self.iobatch([
+                (regs.ucfg_wdata.addr, value),
+                (regs.ucfg_wcmd.addr, LibOV.UCFG_REG_GO | (addr & LibOV.UCFG_REG_ADDRMASK)),
+                (regs.ucfg_wcmd.addr, None)])
+
+            while status & LibOV.UCFG_REG_GO:
+                status = await self.ioread(regs.ucfg_wcmd.addr)
+
+    def packets(self):
+        """Async iterator over captured PacketBatches, ending once the
+        device is closed."""
+        return self.__sink
@@ -0,0 +1,268 @@
+# Multi-process decode pipeline for verbose sniffing
+#
+# Formatting packets as text is far more expensive than framing them, and
+# with one python process it's limited to one core. Here the capture
+# side (the RXCSniff handler) only runs USBInterpreter.sequence() - the
+# cheap, strictly ordered part of decoding - and packs packets and their
+# context into slots of a shared memory ring. Worker processes format whole
+# slots at a time, and a merger thread writes their output back in capture
+# order.
+#
+# Slot layout: a (count, payload length) header, the packet data back to
+# back, then one column per field for count packets.
+
+import array
+import multiprocessing
+import queue
+import struct
+import sys
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+from usb_interp import USBInterpreter
+
+_slot_hdr = struct.Struct("<II")
+
+# crc_ok column value for packets the workers must check themselves
+_CRC_UNCHECKED = 2
+
+# typecode for each column, in slot order. -1 stands in for None.
+_COLUMNS = [
+    ('ts', 'q'),
+    ('delta_print', 'q'),
+    ('delta_subframe', 'q'),
+    ('frameno', 'i'),
+    ('subframe', 'i'),
+    ('flags', 'H'),
+    ('length', 'H'),
+    ('crc_ok', 'B'),
+]
+
+_PER_PACKET = sum(array.array(t).itemsize for _, t in _COLUMNS)
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _columns_at(view, count, plen):
+    cols = {}
+    pos = _align(_slot_hdr.size + plen)
+    for name, typecode in _COLUMNS:
+        size = count * array.array(typecode).itemsize
+        cols[name] = view[pos:pos + size].cast(typecode)
+        pos += _align(size)
+    return cols
+
+def _worker(shm_name, slot_size, tasks, results):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # Only format() is used, which keeps no state
+    interp = USBInterpreter(True)
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            seq, slot = task
+            view = shm.buf[slot * slot_size:(slot + 1) * slot_size]
+
+            count, plen = _slot_hdr.unpack_from(view, 0)
+            payload = bytes(view[_slot_hdr.size:_slot_hdr.size + plen])
+            cols = _columns_at(view, count, plen)
+
+            lines = []
+            pos = 0
+            for i in range(count):
+                frameno = cols['frameno'][i]
+                subframe = cols['subframe'][i]
+                ctx = (cols['ts'][i], cols['delta_print'][i],
+                        None if frameno == -1 else frameno,
+                        None if subframe == -1 else subframe,
+                        cols['delta_subframe'][i])
+
+                end = pos + cols['length'][i]
+                crc_ok = cols['crc_ok'][i]
+                lines.append(interp.format(ctx, payload[pos:end], cols['flags'][i],
+                        None if crc_ok == _CRC_UNCHECKED else crc_ok))
+                pos = end
+
+            for col in cols.values():
+                col.release()
+            view.release()
+
+            results.put((seq, slot, "".join(l + "\n" for l in lines)))
+    finally:
+        shm.close()
+
+class DecodePipeline:
+    def __init__(self, highspeed, workers=None, output=sys.stdout,
+            nslots=None, slot_size=1 << 18, flush_interval=0.05):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if nslots is None:
+            nslots = 4 * workers
+
+        self.output = output
+        self.slot_size = slot_size
+        self.flush_interval = flush_interval
+
+        self.interp = USBInterpreter(highspeed)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=nslots * slot_size)
+
+        # Workers are spawned rather than forked - we're usually started
+        # with the device's threads already running
+        ctx = multiprocessing.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=_worker, daemon=True,
+                args=(self.shm.name, slot_size, self.tasks, self.results))
+                for _ in range(workers)]
+
+        for w in self.workers:
+            w.start()
+
+        self.free = queue.Queue()
+        for slot in range(nslots):
+            self.free.put(slot)
+
+        self.seq = 0
+        self.__new_slot()
+
+        # The capture thread may still be delivering packets while we close
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.merger = threading.Thread(target=self.__merge, daemon=True)
+        self.merger.start()
+
+        # Submits a part filled slot once it's flush_interval old, even if
+        # no more packets come along
+        self.stopping = threading.Event()
+        self.flusher = threading.Thread(target=self.__flush_idle, daemon=True)
+        self.flusher.start()
+
+    def __new_slot(self):
+        # Blocks if the workers have fallen that far behind
+        self.slot = self.free.get()
+        self.plen = 0
+        self.cols = dict((name, array.array(typecode)) for name, typecode in _COLUMNS)
+        self.slot_started = time.monotonic()
+
+    def __submit(self):
+        cols = self.cols
+        count = len(cols['ts'])
+        if not count:
+            self.slot_started = time.monotonic()
+            return
+
+        base = self.slot * self.slot_size
+        buf = self.shm.buf
+
+        _slot_hdr.pack_into(buf, base, count, self.plen)
+        pos = base + _align(_slot_hdr.size + self.plen)
+        for name, _ in _COLUMNS:
+            b = cols[name].tobytes()
+            buf[pos:pos + len(b)] = b
+            pos += _align(len(b))
+
+        self.tasks.put((self.seq, self.slot))
+        self.seq += 1
+
+        self.__new_slot()
+
+    def handle_usb(self, ts, buf, flags):
+        with self.lock:
+            if not self.closed:
+                self.__handle_usb(ts, buf, flags, _CRC_UNCHECKED)
+
+    def handle_batch(self, batch):
+        # The data CRCs are checked here, a batch at a time in libov, rather
+        # than by the workers
+        crcs = batch.check_crc()
+
+        with self.lock:
+            if not self.closed:
+                for (ts, buf, flags), crc_ok in zip(batch, crcs):
+                    self.__handle_usb(ts, buf, flags, crc_ok)
+
+    def __handle_usb(self, ts, buf, flags, crc_ok):
+        # Don't sit on a part filled slot when traffic is light
+        if time.monotonic() - self.slot_started > self.flush_interval:
+            self.__submit()
+
+        ctx = self.interp.sequence(ts, buf, flags)
+        if ctx is None:
+            return
+
+        n = len(buf)
+        count = len(self.cols['ts'])
+        need = _align(_slot_hdr.size + self.plen + n) + \
+                (count + 1) * _PER_PACKET + 8 * len(_COLUMNS)
+        if need > self.slot_size:
+            self.__submit()
+
+        ts, delta_print, frameno, subframe, delta_subframe = ctx
+
+        cols = self.cols
+        cols['ts'].append(ts)
+        cols['delta_print'].append(delta_print)
+        cols['delta_subframe'].append(delta_subframe)
+        cols['frameno'].append(-1 if frameno is None else frameno)
+        cols['subframe'].append(-1 if subframe is None else subframe)
+        cols['flags'].append(flags)
+        cols['length'].append(n)
+        cols['crc_ok'].append(crc_ok)
+
+        pos = self.slot * self.slot_size + _slot_hdr.size + self.plen
+        self.shm.buf[pos:pos + n] = buf
+        self.plen += n
+
+    def __flush_idle(self):
+        while not self.stopping.wait(self.flush_interval):
+            with self.lock:
+                if not self.closed and \
+                        time.monotonic() - self.slot_started > self.flush_interval:
+                    self.__submit()
+
+    def __merge(self):
+        pending = {}
+        next_seq = 0
+
+        while True:
+            r = self.results.get()
+            if r is None:
+                break
+
+            seq, slot, text = r
+            self.free.put(slot)
+            pending[seq] = text
+
+            while next_seq in pending:
+                self.output.write(pending.pop(next_seq))
+                next_seq += 1
+
+        self.output.flush()
+
+    def close(self):
+        self.stopping.set()
+        self.flusher.join()
+
+        with self.lock:
+            self.closed = True
+            self.__submit()
+
+        for w in self.workers:
+            self.tasks.put(None)
+
+        for w in self.workers:
+            w.join()
+
+        self.results.put(None)
+        self.merger.join()
+
+        self.shm.close()
+        self.shm.unlink()
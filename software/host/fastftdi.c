@@ -34,9 +34,19 @@ typedef struct {
    FTDIStreamCallback *callback;
    void *userdata;
    int result;
+   int flags;
    FTDIProgressInfo progress;
 } FTDIStreamState;
 
+struct FTDIStream {
+   FTDIDevice *dev;
+   FTDIStreamState state;
+   struct libusb_transfer **transfers;
+   int numTransfers;
+   bool ownBuffers;
+   volatile int stop;
+};
+
 static int
 DeviceInit(FTDIDevice *dev)
 {
@@ -277,6 +287,68 @@ FTDIDevice_ReadByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t *byte)
 }
 
 
+/*
+ * Submit a transfer, marking it in flight. A status of -1 is never used by
+ * libusb, so it tells us which transfers still need cancelling.
+ */
+
+static int
+SubmitTransfer(struct libusb_transfer *transfer)
+{
+   FTDIStreamState *state = transfer->user_data;
+   int err;
+
+   transfer->status = -1;
+   err = libusb_submit_transfer(transfer);
+   if (err)
+      transfer->status = LIBUSB_TRANSFER_ERROR;
+   else
+      state->progress.transfersInFlight++;
+
+   return err;
+}
+
+
+/*
+ * Strip the FTDI status header from every packet of a completed transfer,
+ * packing the payloads down to the start of the buffer, and hand the whole
+ * thing to the callback at once.
+ */
+
+static int
+ReadStreamCoalesced(FTDIStreamState *state, struct libusb_transfer *transfer)
+{
+   uint8_t *src = transfer->buffer;
+   uint8_t *dst = transfer->buffer;
+   int length = transfer->actual_length;
+
+   while (length > 0) {
+      int packetLen = length;
+
+      if (packetLen > FTDI_PACKET_SIZE)
+         packetLen = FTDI_PACKET_SIZE;
+
+      if (packetLen > FTDI_HEADER_SIZE) {
+         int payloadLen = packetLen - FTDI_HEADER_SIZE;
+
+         memmove(dst, src + FTDI_HEADER_SIZE, payloadLen);
+         dst += payloadLen;
+      }
+
+      src += packetLen;
+      length -= packetLen;
+   }
+
+   length = dst - transfer->buffer;
+   state->progress.current.totalBytes += length;
+
+   if (!length)
+      return 0;
+
+   return state->callback(transfer->buffer, length, NULL, state->userdata);
+}
+
+
 /*
  * Internal callback for one transfer's worth of stream data.
  * Split it into packets and invoke the callbacks.
@@ -288,8 +360,15 @@ ReadStreamCallback(struct libusb_transfer *transfer)
    FTDIStreamState *state = transfer->user_data;
    int err;
 
+   state->progress.transfersInFlight--;
+
    if (state->result == 0) {
-      if (transfer->status == LIBUSB_TRANSFER_COMPLETED) {
+      if (transfer->status == LIBUSB_TRANSFER_COMPLETED &&
+          (state->flags & FTDI_STREAM_COALESCE)) {
+
+         state->result = ReadStreamCoalesced(state, transfer);
+
+      } else if (transfer->status == LIBUSB_TRANSFER_COMPLETED) {
 
          int i;
          uint8_t *ptr = transfer->buffer;
@@ -321,8 +400,7 @@ ReadStreamCallback(struct libusb_transfer *transfer)
    }
 
    if (state->result == 0) {
-      transfer->status = -1;
-      state->result = libusb_submit_transfer(transfer);
+      state->result = SubmitTransfer(transfer);
    }
 }
 
@@ -335,58 +413,192 @@ TimevalDiff(const struct timeval *a, const struct timeval *b)
 
 
 /*
- * Use asynchronous transfers in libusb-1.0 for high-performance
- * streaming of data from a device interface back to the PC. This
- * function continuously transfers data until either an error occurs
- * or the callback returns a nonzero value. This function returns
- * a libusb error code or the callback's return value.
+ * Cancel any outstanding transfers, and wait for them to come back.
+ */
+
+static void
+CancelTransfers(FTDIStream *stream)
+{
+   bool done_cleanup = false;
+   int xferIndex;
+
+   while (!done_cleanup) {
+      done_cleanup = true;
+
+      for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+         struct libusb_transfer *transfer = stream->transfers[xferIndex];
+
+         // If a transfer is in progress, cancel it
+         if (transfer && transfer->status == -1) {
+            libusb_cancel_transfer(transfer);
+
+            // And we need to wait until we get a clean sweep
+            done_cleanup = false;
+         }
+      }
+
+      if (!done_cleanup) {
+         // pump events
+         struct timeval timeout = { 0, 10000 };
+         libusb_handle_events_timeout(stream->dev->libusb, &timeout);
+      }
+   }
+}
+
+
+/*
+ * A stream owns its transfers and their buffers for its whole lifetime.
+ * They're allocated once here, and each FTDIStream_Run submits the same
+ * transfers again, so a stream can be stopped and restarted as often as
+ * needed without going back to the allocator.
  *
- * For every contiguous block of received data, the callback will
- * be invoked.
+ * Returns NULL if memory could not be allocated.
  */
 
-int
-FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
-                      FTDIStreamCallback *callback, void *userdata,
-                      int packetsPerTransfer, int numTransfers)
+FTDIStream *
+FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+               FTDIStreamCallback *callback, void *userdata,
+               int packetsPerTransfer, int numTransfers, int flags)
 {
-   struct libusb_transfer **transfers;
-   FTDIStreamState state = { callback, userdata };
+   return FTDIStream_NewWithBuffers(dev, interface, callback, userdata,
+                                    packetsPerTransfer, numTransfers, flags,
+                                    NULL);
+}
+
+
+/*
+ * As FTDIStream_New, but transfer i reads into buffers[i], which must be
+ * packetsPerTransfer * FTDI_PACKET_SIZE bytes long. The buffers remain the
+ * caller's, and must outlive the stream.
+ *
+ * With FTDI_STREAM_COALESCE the callback's buffer always points into one of
+ * them, so the caller can find the data without copying it out.
+ */
+
+FTDIStream *
+FTDIStream_NewWithBuffers(FTDIDevice *dev, FTDIInterface interface,
+                          FTDIStreamCallback *callback, void *userdata,
+                          int packetsPerTransfer, int numTransfers, int flags,
+                          uint8_t **buffers)
+{
+   FTDIStream *stream;
    int bufferSize = packetsPerTransfer * FTDI_PACKET_SIZE;
    int xferIndex;
-   int err = 0;
 
-   /*
-    * Set up all transfers
-    */
+   stream = calloc(1, sizeof *stream);
+   if (!stream)
+      return NULL;
 
-   transfers = calloc(numTransfers, sizeof *transfers);
-   if (!transfers) {
-      err = LIBUSB_ERROR_NO_MEM;
-      goto cleanup;
-   }
+   stream->dev = dev;
+   stream->state.callback = callback;
+   stream->state.userdata = userdata;
+   stream->state.flags = flags;
+   stream->numTransfers = numTransfers;
+   stream->ownBuffers = !buffers;
+
+   stream->transfers = calloc(numTransfers, sizeof *stream->transfers);
+   if (!stream->transfers)
+      goto fail;
 
    for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
       struct libusb_transfer *transfer;
+      uint8_t *buffer;
 
       transfer = libusb_alloc_transfer(0);
-      transfers[xferIndex] = transfer;
-      if (!transfer) {
-         err = LIBUSB_ERROR_NO_MEM;
-         goto cleanup;
-      }
+      stream->transfers[xferIndex] = transfer;
+      if (!transfer)
+         goto fail;
+
+      buffer = buffers ? buffers[xferIndex] : malloc(bufferSize);
 
       libusb_fill_bulk_transfer(transfer, dev->handle, FTDI_EP_IN(interface),
-                                malloc(bufferSize), bufferSize, ReadStreamCallback,
-                                &state, 0);
+                                buffer, bufferSize, ReadStreamCallback,
+                                &stream->state, 0);
 
-      if (!transfer->buffer) {
-         err = LIBUSB_ERROR_NO_MEM;
-         goto cleanup;
+      if (!transfer->buffer)
+         goto fail;
+
+      transfer->status = 0;
+   }
+
+   return stream;
+
+ fail:
+   FTDIStream_Free(stream);
+   return NULL;
+}
+
+
+/*
+ * Free a stream and its transfers. The stream must not be running.
+ */
+
+void
+FTDIStream_Free(FTDIStream *stream)
+{
+   int xferIndex;
+
+   if (!stream)
+      return;
+
+   if (stream->transfers) {
+      for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+         struct libusb_transfer *transfer = stream->transfers[xferIndex];
+
+         if (transfer) {
+            if (stream->ownBuffers)
+               free(transfer->buffer);
+            libusb_free_transfer(transfer);
+         }
       }
+      free(stream->transfers);
+   }
 
-      transfer->status = -1;
-      err = libusb_submit_transfer(transfer);
+   free(stream);
+}
+
+
+/*
+ * Ask a running stream to return from FTDIStream_Run at the next event
+ * loop iteration. Safe to call from another thread. If the stream isn't
+ * running yet, the next FTDIStream_Run returns straight away instead.
+ */
+
+void
+FTDIStream_Stop(FTDIStream *stream)
+{
+   stream->stop = 1;
+}
+
+
+/*
+ * Stream data until either an error occurs, the callback returns a nonzero
+ * value or FTDIStream_Stop is called. Outstanding transfers are cancelled
+ * before returning, but stay allocated for the next run. Returns a libusb
+ * error code or the callback's return value (0 when stopped).
+ *
+ * For every contiguous block of received data, the callback will
+ * be invoked.
+ */
+
+int
+FTDIStream_Run(FTDIStream *stream)
+{
+   FTDIStreamState *state = &stream->state;
+   int xferIndex, result;
+   int err = 0;
+
+   // Stopped before it got going
+   if (stream->stop) {
+      stream->stop = 0;
+      return 0;
+   }
+
+   memset(&state->progress, 0, sizeof state->progress);
+   state->result = 0;
+
+   for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+      err = SubmitTransfer(stream->transfers[xferIndex]);
       if (err)
          goto cleanup;
    }
@@ -395,17 +607,17 @@ FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
     * Run the transfers, and periodically assess progress.
     */
 
-   gettimeofday(&state.progress.first.time, NULL);
+   gettimeofday(&state->progress.first.time, NULL);
 
    do {
-      FTDIProgressInfo  *progress = &state.progress;
+      FTDIProgressInfo  *progress = &state->progress;
       const double progressInterval = 0.1;
       struct timeval timeout = { 0, 10000 };
       struct timeval now;
 
-      int err = libusb_handle_events_timeout(dev->libusb, &timeout);
-      if (!state.result) {
-         state.result = err;
+      int err = libusb_handle_events_timeout(stream->dev->libusb, &timeout);
+      if (!state->result) {
+         state->result = err;
       }
 
       // If enough time has elapsed, update the progress
@@ -429,54 +641,77 @@ FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
                                      progress->prev.totalBytes) / currentTime;
          }
 
-         state.result = state.callback(NULL, 0, progress, state.userdata);
+         if (!state->result) {
+            state->result = state->callback(NULL, 0, progress, state->userdata);
+         }
          progress->prev = progress->current;
       }
-   } while (!state.result);
+   } while (!state->result && !stream->stop);
 
    /*
-    * Cancel any outstanding transfers, and free memory.
+    * Cancel whatever is still outstanding. A nonzero result keeps the
+    * transfer callbacks from resubmitting meanwhile.
     */
 
  cleanup:
-   if (transfers) {
-      bool done_cleanup = false;
-      while (!done_cleanup)
-      {
-          done_cleanup = true;
-
-          for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
-             struct libusb_transfer *transfer = transfers[xferIndex];
-
-             if (transfer) {
-                // If a transfer is in progress, cancel it
-                if (transfer->status == -1) {
-                   libusb_cancel_transfer(transfer);
-
-                   // And we need to wait until we get a clean sweep
-                   done_cleanup = false;
-
-                // If a transfer is complete or cancelled, nuke it
-                } else if (transfer->status == 0 ||
-                        transfer->status == LIBUSB_TRANSFER_CANCELLED) {
-                    free(transfer->buffer);
-                    libusb_free_transfer(transfer);
-                    transfers[xferIndex] = NULL;
-                }
-             }
-          }
-
-          // pump events
-          struct timeval timeout = { 0, 10000 };
-          libusb_handle_events_timeout(dev->libusb, &timeout);
-      }
-      free(transfers);
-   }
+   result = state->result;
+   state->result = -1;
+   CancelTransfers(stream);
+
+   // This run is over; a stop from now on is for the next one
+   stream->stop = 0;
 
    if (err)
       return err;
    else
-      return state.result;
+      return result;
+}
+
+
+/*
+ * Use asynchronous transfers in libusb-1.0 for high-performance
+ * streaming of data from a device interface back to the PC. This
+ * function continuously transfers data until either an error occurs
+ * or the callback returns a nonzero value. This function returns
+ * a libusb error code or the callback's return value.
+ *
+ * For every contiguous block of received data, the callback will
+ * be invoked.
+ */
+
+int
+FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
+                      FTDIStreamCallback *callback, void *userdata,
+                      int packetsPerTransfer, int numTransfers)
+{
+   return FTDIDevice_ReadStreamEx(dev, interface, callback, userdata,
+                                  packetsPerTransfer, numTransfers, 0);
+}
+
+
+/*
+ * As FTDIDevice_ReadStream, with FTDI_STREAM_* flags. This is a one-shot
+ * FTDIStream; use one directly to keep the transfers between runs.
+ */
+
+int
+FTDIDevice_ReadStreamEx(FTDIDevice *dev, FTDIInterface interface,
+                        FTDIStreamCallback *callback, void *userdata,
+                        int packetsPerTransfer, int numTransfers,
+                        int flags)
+{
+   FTDIStream *stream;
+   int err;
+
+   stream = FTDIStream_New(dev, interface, callback, userdata,
+                           packetsPerTransfer, numTransfers, flags);
+   if (!stream)
+      return LIBUSB_ERROR_NO_MEM;
+
+   err = FTDIStream_Run(stream);
+   FTDIStream_Free(stream);
+
+   return err;
 }
 
 /* MPSSE mode support -- see
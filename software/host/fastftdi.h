@@ -69,6 +69,8 @@ typedef struct {
    double totalTime;
    double totalRate;
    double currentRate;
+
+   int transfersInFlight;
 } FTDIProgressInfo;
 
 
@@ -97,6 +99,22 @@ typedef struct {
 typedef int (FTDIStreamCallback)(uint8_t *buffer, int length,
                                  FTDIProgressInfo *progress, void *userdata);
 
+/*
+ * Stream flags
+ */
+
+// Invoke the callback once per completed transfer rather than once per
+// FTDI packet. The 2-byte FTDI status headers are stripped in place, so the
+// buffer holds only the contiguous payload.
+#define FTDI_STREAM_COALESCE      (1 << 0)
+
+/*
+ * A read stream whose transfers are allocated once and reused by every
+ * FTDIStream_Run, so it can be stopped and restarted without teardown.
+ */
+
+typedef struct FTDIStream FTDIStream;
+
 
 /*
  * Public Functions
@@ -119,6 +137,22 @@ int FTDIDevice_ReadByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t *b
 int FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
                           FTDIStreamCallback *callback, void *userdata,
                           int packetsPerTransfer, int numTransfers);
+int FTDIDevice_ReadStreamEx(FTDIDevice *dev, FTDIInterface interface,
+                            FTDIStreamCallback *callback, void *userdata,
+                            int packetsPerTransfer, int numTransfers,
+                            int flags);
+
+FTDIStream *FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+                           FTDIStreamCallback *callback, void *userdata,
+                           int packetsPerTransfer, int numTransfers,
+                           int flags);
+FTDIStream *FTDIStream_NewWithBuffers(FTDIDevice *dev, FTDIInterface interface,
+                                      FTDIStreamCallback *callback, void *userdata,
+                                      int packetsPerTransfer, int numTransfers,
+                                      int flags, uint8_t **buffers);
+int FTDIStream_Run(FTDIStream *stream);
+void FTDIStream_Stop(FTDIStream *stream);
+void FTDIStream_Free(FTDIStream *stream);
 
 int FTDIDevice_MPSSE_Enable(FTDIDevice *dev, FTDIInterface interface);
 int FTDIDevice_MPSSE_SetDivisor(FTDIDevice *dev, FTDIInterface interface,
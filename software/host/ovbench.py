@@ -0,0 +1,693 @@
+#!/usr/bin/python3.3
+
+# Offline benchmarks for the host-side stream processing. None of these
+# need a device attached - they run against synthetic data.
+
+import LibOV
+import argparse
+import contextlib
+import ctypes
+import functools
+import os
+import queue
+import random
+import struct
+import subprocess
+import sys
+import time
+
+import usb_interp
+from textsink import TextSink
+from usb_interp import hd
+
+def synth_capture(npackets, size, seed=0):
+    """Build a synthetic capture stream of 0xA0 packets."""
+    rnd = random.Random(seed)
+    out = bytearray()
+    ts = 0
+    for i in range(npackets):
+        flags = LibOV.HF0_FIRST if i == 0 else 0
+        ts = (ts + rnd.randrange(1, 2000)) & 0xFFFFFF
+        payload = bytes(rnd.getrandbits(8) for _ in range(size))
+        out += struct.pack("<BHH", 0xA0, flags, size)
+        out += struct.pack("<I", ts)[:3]
+        out += payload
+
+    return bytes(out)
+
+def chunks(stream, n=510):
+    """Split a stream into FTDI-payload sized pieces."""
+    return [stream[i:i + n] for i in range(0, len(stream), n)]
+
+# The framer as it was before the ring buffer and dispatch table, frozen
+# along with its services: the backlog is kept in a bytes object that's
+# appended to and then sliced once per message, each service is asked in
+# turn whether it owns the next byte, and every message is copied and
+# consumed on its own, capture packets going to the handlers one at a time.
+class _LegacyService:
+    def matchMagic(self, byt):
+        return byt == self.MAGIC
+
+    def getNeededSizeForMagic(self, byt):
+        return self.NEEDED_FOR_SIZE
+
+    def presentBytes(self, b):
+        if not self.matchMagic(b[0]):
+            return 0
+
+        if len(b) < self.getNeededSizeForMagic(b[0]):
+            return LibOV.INCOMPLETE
+
+        size = self.getPacketSize(b)
+
+        if len(b) < size:
+            return LibOV.INCOMPLETE
+
+        self.consume(b[:size])
+
+        return size
+
+class _LegacyIO(_LegacyService):
+    MAGIC = 0x55
+    NEEDED_FOR_SIZE = 1
+
+    def __init__(self):
+        self.q = queue.Queue()
+
+    def getPacketSize(self, buf):
+        return 5
+
+    def consume(self, buf):
+        calc_ck = (sum(buf[0:4]) & 0xFF)
+
+        if calc_ck != buf[4]:
+            raise LibOV.ProtocolError(
+                "Checksum for response incorrect: expected %02x, got %02x" %
+                (calc_ck, buf[4])
+            )
+
+        self.q.put((buf[1] << 8 | buf[2], buf[3]))
+
+class _LegacyLFSRTest(_LegacyService):
+    MAGIC = 0xAA
+    NEEDED_FOR_SIZE = 2
+
+    def __init__(self):
+        self.state = None
+        self.error = 0
+        self.total = 0
+
+    def getPacketSize(self, buf):
+        return buf[1] + 2
+
+    def consume(self, buf):
+        self.total += buf[1]
+
+        if self.state != None:
+            if buf[2] & 0xFE != (self.state << 1) & 0xFE:
+                self.error = 1
+
+        self.state = buf[-1]
+
+class _LegacyRXCSniff(_LegacyService):
+    def __init__(self):
+        self.handlers = []
+        self.got_start = False
+
+    def getNeededSizeForMagic(self, b):
+        if b == 0xA0:
+            return 5
+        return 1
+
+    def matchMagic(self, byt):
+        return byt == 0xAC or byt == 0xAD or byt == 0xA0
+
+    def getPacketSize(self, buf):
+        if buf[0] != 0xA0:
+            return 2
+        else:
+            return (buf[4] << 8 | buf[3]) + 8
+
+    def consume(self, buf):
+        if buf[0] == 0xA0:
+            flags = buf[1] | buf[2] << 8
+
+            ts = buf[5] | buf[6] << 8 | buf[7] << 16
+
+            if flags != 0 and flags != LibOV.HF0_FIRST and flags != LibOV.HF0_LAST:
+                print("PERR: %04X (%s)" % (flags, LibOV.decode_flags(flags)))
+
+            if flags & LibOV.HF0_FIRST:
+                self.got_start = True
+
+            if self.got_start:
+                self.handle_usb(ts, buf[8:], flags)
+
+            if flags & LibOV.HF0_LAST:
+                self.got_start = False
+
+    def handle_usb(self, ts, buf, flags):
+        for handler in self.handlers:
+            handler(ts, buf, flags)
+
+class LegacyFramer:
+    # services is ignored, the legacy framer only works with its own copies
+    def __init__(self, services):
+        self.services = [_LegacyIO(), _LegacyLFSRTest(), _LegacyRXCSniff()]
+        self.buf = b""
+
+    def feed(self, b):
+        self.buf += b
+
+        incomplete = False
+
+        while self.buf and not incomplete:
+            for service in self.services:
+                code = service.presentBytes(self.buf)
+                if code == LibOV.INCOMPLETE:
+                    incomplete = True
+                    break
+                elif code:
+                    self.buf = self.buf[code:]
+                    break
+            else:
+                print("Unmatched byte %02x - discarding" % self.buf[0])
+                self.buf = self.buf[1:]
+
+_OVFramer_StreamCallback = LibOV.libov.OVFramer_StreamCallback
+_OVFramer_StreamCallback.argtypes = [ctypes.c_char_p, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_void_p]
+_OVFramer_StreamCallback.restype = ctypes.c_int
+
+# libov's framer, fed the way FTDI_STREAM_COALESCE would
+class NativeFramer:
+    def __init__(self, services):
+        self.framer = LibOV.StreamFramer(services)
+        self.cb = LibOV.p_cb_BatchCallback(self.__batch)
+        self.native = LibOV.OVFramer_New(self.cb, None)
+        self.calls = 0
+
+    def __del__(self):
+        LibOV.OVFramer_Free(self.native)
+
+    def __batch(self, batch, prog, user):
+        self.calls += 1
+        self.framer.feed_batch(batch.contents)
+        return 0
+
+    def feed(self, b):
+        _OVFramer_StreamCallback(b, len(b), None, self.native)
+
+def run_framer(framer_cls, pieces, total):
+    sniff = LibOV.RXCSniff()
+    sniff.service.handlers = []
+
+    framer = framer_cls([LibOV.IO().service, LibOV.LFSRTest().service,
+        sniff.service])
+
+    st = time.perf_counter()
+    for piece in pieces:
+        framer.feed(piece)
+    rate = total / (time.perf_counter() - st)
+
+    # On a device the python framers get a callback per FTDI packet however
+    # the data was batched here
+    return rate, getattr(framer, 'calls', (total + 509) // 510)
+
+def bench_framer(args):
+    stream = synth_capture(args.packets, args.size)
+    pieces = chunks(stream)
+
+    # Without a device the stream arrives all at once rather than trickling
+    # in, so feed enough pieces per pass to build the backlog that makes the
+    # legacy framer go quadratic.
+    batched = [b"".join(pieces[i:i + args.batch])
+            for i in range(0, len(pieces), args.batch)]
+
+    print("framer: %d packets x %d bytes, %d bytes per feed" % (
+        args.packets, args.size, 510 * args.batch))
+
+    for name, cls in [("legacy", LegacyFramer), ("ring", LibOV.StreamFramer),
+            ("native", NativeFramer)]:
+        rate, calls = run_framer(cls, batched, len(stream))
+        print("\t%-8s %10.2f MB/sec %8d python calls" % (name, rate / 1024 / 1024, calls))
+
+def read_pcap(f):
+    """Read the packets of an "ovctl sniff --format pcap" capture."""
+    hdr = struct.Struct("IIIIH")
+
+    f.read(24)
+    packets = []
+    while True:
+        rec = f.read(hdr.size)
+        if len(rec) < hdr.size:
+            break
+
+        _, _, incl_len, _, flags = hdr.unpack(rec)
+        packets.append((0, f.read(incl_len - 2), flags))
+
+    return packets
+
+def _pid(pid):
+    return pid | (pid ^ 0xF) << 4
+
+def synth_usb(npackets, seed=0):
+    """Build high speed bus traffic: SOFs every 125us and mostly IN/NAK
+    polling, with some data."""
+    rnd = random.Random(seed)
+    crc16 = usb_interp.USBInterpreter.data_crc
+
+    def token(pid, v):
+        w = v | usb_interp.crc5(v) << 11
+        return bytes([_pid(pid), w & 0xFF, w >> 8])
+
+    packets = []
+    ts = 0
+    frame = 0
+    while len(packets) < npackets:
+        ts = (ts + 7500) & 0xFFFFFF
+        frame = (frame + 1) & 0x7FF
+        packets.append((ts, token(0x5, frame >> 3), 0))
+
+        for i in range(rnd.randrange(4, 12)):
+            ts = (ts + 300) & 0xFFFFFF
+            packets.append((ts, token(0x9, rnd.randrange(1, 8) | rnd.randrange(1, 3) << 7), 0))
+
+            if rnd.random() < 0.8:
+                packets.append((ts + 20, bytes([_pid(0xA)]), 0))
+            else:
+                data = bytes(rnd.getrandbits(8) for _ in range(rnd.randrange(8, 64)))
+                c = crc16(data) ^ 0xFFFF
+                packets.append((ts + 20, bytes([_pid(0x3)]) + data + bytes([c & 0xFF, c >> 8]), 0))
+                packets.append((ts + 40, bytes([_pid(0x2)]), 0))
+
+    return packets[:npackets]
+
+# USBInterpreter as it was before the PID and token tables and the split
+# into records, frozen: handlePacket decodes and formats each packet in one
+# pass, returning the line rather than printing it. describe() is its
+# message building on its own, timed for the "decoded" column.
+class LegacyInterpreter:
+    import crcmod
+    data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
+
+    def __init__(self, highspeed):
+        self.frameno = None
+        self.subframe = 0
+        self.highspeed = True
+
+        self.last_ts_frame = 0
+
+        self.last_ts_print = 0
+        self.last_ts_pkt = 0
+        self.ts_base = 0
+        self.ts_roll_cyc = 2**24
+
+    def handlePacket(self, ts, buf, flags):
+        CRC_BAD = 1
+        CRC_GOOD = 2
+        CRC_NONE = 3
+        crc_check = CRC_NONE
+
+        ts_delta_pkt = ts - self.last_ts_pkt
+        self.last_ts_pkt = ts
+
+        if ts_delta_pkt < 0:
+            self.ts_base += self.ts_roll_cyc
+
+        ts += self.ts_base
+
+
+        suppress = False
+
+        #msg = "(%s)" % " ".join("%02x" % i for i in buf)
+        msg = ""
+
+        if len(buf) != 0:
+            pid = buf[0] & 0xF
+            if (buf[0] >> 4) ^ 0xF != pid:
+                msg += "Err - bad PID of %02x" % pid
+            elif pid == 0x5:
+                if len(buf) < 3:
+                    msg += "RUNT frame"
+                else:
+                    frameno = buf[1] | (buf[2] << 8) & 0x7
+                    if self.frameno == None:
+                        self.subframe = None
+                    else:
+                        if self.subframe == None:
+                            if frameno == (self.frameno + 1) & 0xFF:
+                                self.subframe = 0 if self.highspeed else None
+                        else:
+                            self.subframe += 1
+                            if self.subframe == 8:
+                                if frameno == (self.frameno + 1)&0xFF:
+                                    self.subframe = 0
+                                else:
+                                    msg += "WTF Subframe %d" % self.frameno
+                                    self.subframe = None
+                            elif self.frameno != frameno:
+                                msg += "WTF frameno %d" % self.frameno
+                                self.subframe = None
+
+                    self.frameno = frameno
+
+                    self.last_ts_frame = ts
+                    suppress = True
+                    msg += "Frame %d.%c" % (frameno, '?' if self.subframe == None else "%d" % self.subframe)
+            elif pid in [0x3, 0xB, 0x7]:
+                n = {3:0, 0xB:1, 0x7:2}[pid]
+
+                msg += "DATA%d: %s" % (n,hd(buf[1:]))
+
+                if len(buf) > 2:
+                    calc_check = self.data_crc(buf[1:-2])^0xFFFF
+                    pkt_check = buf[-2] | buf[-1] << 8
+
+                    if calc_check != pkt_check:
+                        msg += "\tUnexpected ERR CRC"
+
+            elif pid == 0xF:
+                msg += "MDATA: %s" % hd(buf[1:])
+            elif pid in [0x01, 0x09, 0x0D, 0x04]:
+                if pid == 1:
+                    name = "OUT"
+                elif pid == 9:
+                    name = "IN"
+                elif pid == 0xD:
+                    name = "SETUP"
+                elif pid == 0x04:
+                    name = "PING"
+                if len(buf) < 3:
+                    msg += "RUNT: %s %s" % (name, " ".join("%02x" % i for i in buf))
+                else:
+
+                    addr = buf[1] & 0x7F
+                    endp = (buf[2] & 0x7) << 1 | buf[1] >> 7
+
+                    msg += "%-5s: %d.%d" % (name, addr, endp)
+            elif pid == 2:
+                msg += "ACK"
+            elif pid == 0xA:
+                msg += "NAK"
+            elif pid == 0xE:
+                msg += "STALL"
+            elif pid == 0x6:
+                msg += "NYET"
+            elif pid == 0xC:
+                msg += "PRE-ERR"
+                pass
+            elif pid == 0x8:
+                msg += "SPLIT"
+                pass
+            else:
+                msg += "WUT"
+
+        if not suppress:
+            crc_char_d = {
+                CRC_BAD: '!',
+                CRC_GOOD: 'C',
+                CRC_NONE: ' '
+            }
+
+            flag_field = "[  %s%s%s%s%s%s]" % (
+                'L' if flags & 0x20 else ' ',
+                'F' if flags & 0x10 else ' ',
+                'T' if flags & 0x08 else ' ',
+                'C' if flags & 0x04 else ' ',
+                'O' if flags & 0x02 else ' ',
+                'E' if flags & 0x01 else ' ')
+            delta_subframe = ts - self.last_ts_frame
+            delta_print = ts - self.last_ts_print
+            self.last_ts_print = ts
+            RATE=60.0e6
+
+            subf_print = ''
+            frame_print = ''
+
+            if self.frameno != None:
+                frame_print = "%3d" % self.frameno
+
+            if self.subframe != None:
+                subf_print = ".%d" % self.subframe
+
+            return ("%s %10.6f d=%10.6f [%3s%2s +%7.3f] [%3d] %s " % (
+                    flag_field, ts/RATE, (delta_print)/RATE,
+                    frame_print, subf_print, delta_subframe/RATE * 1E6,
+                    len(buf), msg))
+
+    def describe(self, buf):
+        msg = ""
+
+        if len(buf) != 0:
+            pid = buf[0] & 0xF
+            if (buf[0] >> 4) ^ 0xF != pid:
+                msg += "Err - bad PID of %02x" % pid
+            elif pid == 0x5:
+                msg += "RUNT frame"
+            elif pid in [0x3, 0xB, 0x7]:
+                n = {3:0, 0xB:1, 0x7:2}[pid]
+
+                msg += "DATA%d: %s" % (n, hd(buf[1:]))
+
+                if len(buf) > 2:
+                    calc_check = self.data_crc(buf[1:-2])^0xFFFF
+                    pkt_check = buf[-2] | buf[-1] << 8
+
+                    if calc_check != pkt_check:
+                        msg += "\tUnexpected ERR CRC"
+
+            elif pid == 0xF:
+                msg += "MDATA: %s" % hd(buf[1:])
+            elif pid in [0x01, 0x09, 0x0D, 0x04]:
+                if pid == 1:
+                    name = "OUT"
+                elif pid == 9:
+                    name = "IN"
+                elif pid == 0xD:
+                    name = "SETUP"
+                elif pid == 0x04:
+                    name = "PING"
+                if len(buf) < 3:
+                    msg += "RUNT: %s %s" % (name, " ".join("%02x" % i for i in buf))
+                else:
+                    addr = buf[1] & 0x7F
+                    endp = (buf[2] & 0x7) << 1 | buf[1] >> 7
+
+                    msg += "%-5s: %d.%d" % (name, addr, endp)
+            elif pid == 2:
+                msg += "ACK"
+            elif pid == 0xA:
+                msg += "NAK"
+            elif pid == 0xE:
+                msg += "STALL"
+            elif pid == 0x6:
+                msg += "NYET"
+            elif pid == 0xC:
+                msg += "PRE-ERR"
+            elif pid == 0x8:
+                msg += "SPLIT"
+            else:
+                msg += "WUT"
+
+        return msg
+
+def run_interp(interp_cls, packets):
+    interp = interp_cls(True)
+    describe = interp.describe
+
+    printed = []
+
+    st = time.perf_counter()
+    if isinstance(interp, LegacyInterpreter):
+        handle = interp.handlePacket
+        for ts, buf, flags in packets:
+            if handle(ts, buf, flags) is not None:
+                printed.append(buf)
+    else:
+        decode = interp.decode
+        format_record = interp.format_record
+        for ts, buf, flags in packets:
+            rec = decode(ts, buf, flags)
+            if rec is not None:
+                format_record(rec)
+                printed.append(rec)
+    full = len(packets) / (time.perf_counter() - st)
+
+    # Decoding alone, of the packets that are printed
+    st = time.perf_counter()
+    for item in printed:
+        describe(item)
+    decode = len(printed) / (time.perf_counter() - st)
+
+    return full, decode
+
+def bench_interp(args):
+    if args.pcap:
+        with open(args.pcap, "rb") as f:
+            packets = read_pcap(f)
+        source = args.pcap
+    else:
+        packets = synth_usb(args.packets)
+        source = "synthetic high speed traffic"
+
+    print("interp: %d packets from %s" % (len(packets), source))
+
+    for name, cls in [("legacy", LegacyInterpreter), ("tables", usb_interp.USBInterpreter),
+            ("brief", functools.partial(usb_interp.USBInterpreter, brief=True))]:
+        full, decode = run_interp(cls, packets)
+        print("\t%-8s %10.0f packets/sec decoded, %10.0f formatted" % (name, decode, full))
+
+def make_batch(packets):
+    batch = LibOV.PacketBatch()
+    payload = bytearray()
+    for ts, buf, flags in packets:
+        batch.offset.append(len(payload))
+        batch.length.append(len(buf))
+        batch.flags.append(flags)
+        batch.ts.append(ts)
+        payload += buf
+
+    batch.payload = bytes(payload)
+    return batch
+
+def bench_crc(args):
+    rnd = random.Random(0)
+    crc16 = usb_interp.USBInterpreter.data_crc
+
+    packets = []
+    for i in range(args.packets):
+        data = bytes(rnd.getrandbits(8) for _ in range(args.size))
+        c = crc16(data) ^ 0xFFFF ^ (rnd.random() < 0.01)
+        packets.append((0, bytes([_pid(0x3)]) + data + bytes([c & 0xFF, c >> 8]), 0))
+
+    batches = [make_batch(packets[i:i + args.batch])
+            for i in range(0, len(packets), args.batch)]
+
+    total = args.packets * (args.size + 3)
+    print("crc: %d DATA packets x %d bytes, %d per batch" % (
+        args.packets, args.size, args.batch))
+
+    st = time.perf_counter()
+    bad = 0
+    for batch in batches:
+        for ts, buf, flags in batch:
+            if crc16(buf[1:-2]) ^ 0xFFFF != buf[-2] | buf[-1] << 8:
+                bad += 1
+    rate = total / (time.perf_counter() - st)
+    print("\t%-8s %10.2f MB/sec %6d bad" % ("crcmod", rate / 1024 / 1024, bad))
+
+    st = time.perf_counter()
+    bad = 0
+    for batch in batches:
+        bad += len(batch) - sum(batch.check_crc())
+    rate = total / (time.perf_counter() - st)
+    print("\t%-8s %10.2f MB/sec %6d bad" % ("batch", rate / 1024 / 1024, bad))
+
+@contextlib.contextmanager
+def text_target(kind):
+    """A file descriptor writing to /dev/null, or to a pipe read by cat"""
+    if kind == "null":
+        fd = os.open(os.devnull, os.O_WRONLY)
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+    else:
+        proc = subprocess.Popen(["cat"], stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL)
+        try:
+            yield proc.stdin.fileno()
+        finally:
+            proc.stdin.close()
+            proc.wait()
+
+def text_print(fd, lines, args, buffering):
+    f = open(fd, "w", buffering=buffering, closefd=False)
+    for line in lines:
+        print(line, file=f)
+    f.flush()
+
+def text_sink(fd, lines, args):
+    f = open(fd, "w", closefd=False)
+    sink = TextSink(f, args.buffer, flush_interval=None)
+    for i in range(0, len(lines), args.batch):
+        sink.writelines([line + "\n" for line in lines[i:i + args.batch]])
+    sink.close()
+
+# ChandlePacket prints to the process' stdout, so point that at the target
+def text_c(fd, packets, args, size):
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(fd, 1)
+    try:
+        LibOV.OV_SetTextBuffer(size, 100)
+        for ts, buf, flags in packets:
+            LibOV.ChandlePacket(ts, flags, buf, len(buf))
+        # Flushes what's left
+        LibOV.OV_SetTextBuffer(size, 100)
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def bench_text(args):
+    packets = synth_usb(args.packets)
+
+    interp = usb_interp.USBInterpreter(True)
+    lines = [interp.format_record(rec) for rec in interp.decode_batch(make_batch(packets))]
+
+    print("text: %d lines, sink buffer %d, %d lines per batch" % (
+        len(lines), args.buffer, args.batch))
+
+    writers = [
+        ("print", lambda fd: text_print(fd, lines, args, -1)),
+        ("print/line", lambda fd: text_print(fd, lines, args, 1)),
+        ("sink", lambda fd: text_sink(fd, lines, args)),
+        ("C/4k", lambda fd: text_c(fd, packets, args, 4096)),
+        ("C/sink", lambda fd: text_c(fd, packets, args, args.buffer)),
+    ]
+
+    for target in ["null", "pipe"]:
+        for name, writer in writers:
+            with text_target(target) as fd:
+                st = time.perf_counter()
+                writer(fd)
+                rate = len(lines) / (time.perf_counter() - st)
+            print("\t%-5s %-10s %10.0f lines/sec" % (target, name, rate))
+
+def main():
+    ap = argparse.ArgumentParser()
+    subparsers = ap.add_subparsers()
+
+    sp = subparsers.add_parser("framer")
+    sp.add_argument("--packets", type=int, default=20000)
+    sp.add_argument("--size", type=int, default=800)
+    sp.add_argument("--batch", type=int, default=128)
+    sp.set_defaults(hdlr=bench_framer)
+
+    sp = subparsers.add_parser("interp")
+    sp.add_argument("--pcap", help="capture written by ovctl sniff --format pcap")
+    sp.add_argument("--packets", type=int, default=200000)
+    sp.set_defaults(hdlr=bench_interp)
+
+    sp = subparsers.add_parser("crc")
+    sp.add_argument("--packets", type=int, default=20000)
+    sp.add_argument("--size", type=int, default=512)
+    sp.add_argument("--batch", type=int, default=64)
+    sp.set_defaults(hdlr=bench_crc)
+
+    sp = subparsers.add_parser("text")
+    sp.add_argument("--packets", type=int, default=200000)
+    sp.add_argument("--buffer", type=int, default=1 << 16)
+    sp.add_argument("--batch", type=int, default=64)
+    sp.set_defaults(hdlr=bench_text)
+
+    args = ap.parse_args()
+
+    if hasattr(args, 'hdlr'):
+        args.hdlr(args)
+    else:
+        ap.print_help()
+
+if __name__ == "__main__":
+    main()
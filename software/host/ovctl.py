@@ -12,6 +12,9 @@ import zipfile
 import sys
 import os
 import struct
+
+from textsink import TextSink
+from usb_interp import USBInterpreter
 #import yappi
 
 def as_ascii(arg):
@@ -82,6 +85,31 @@ def uread(dev, addr):
 
     print ("ULPI %02x: %02x" % (addr, dev.ulpiread(addr)))
 
+@command('ulpi-dump')
+def ulpi_dump(dev):
+    if check_ulpi_clk(dev):
+        return
+
+    st = time.time()
+    snapshot = dev.ulpi_snapshot()
+    batched = time.time() - st
+
+    st = time.time()
+    for name in LibOV.SMSC_334x_SNAPSHOT:
+        dev.ulpiread_polled(LibOV.SMSC_334x_MAP[name])
+    polled = time.time() - st
+
+    for name in LibOV.SMSC_334x_SNAPSHOT:
+        print("%-16s %02x: %02x" % (name, LibOV.SMSC_334x_MAP[name], snapshot[name]))
+
+    st = time.time()
+    dev.ulpi_restore(snapshot)
+    restore = time.time() - st
+
+    print("snapshot of %d registers: %.2f ms (%.2f ms one at a time), "
+            "no-op restore: %.2f ms" % (len(snapshot), batched * 1000,
+                polled * 1000, restore * 1000))
+
 @command('report')
 def report(dev):
 
@@ -91,12 +119,12 @@ def report(dev):
     else:
         # display the ULPI identifier
         ident = 0
-        for x in [dev.ulpiregs.vidh,
-                dev.ulpiregs.vidl,
-                dev.ulpiregs.pidh,
-                dev.ulpiregs.pidl]:
+        for x in dev.ulpiread_batch([dev.ulpiregs.vidh.addr,
+                dev.ulpiregs.vidl.addr,
+                dev.ulpiregs.pidh.addr,
+                dev.ulpiregs.pidl.addr]):
             ident <<= 8
-            ident |= x.rd()
+            ident |= x
 
         name = 'unknown'
         if ident == LibOV.SMSC_334x_MAGIC:
@@ -126,25 +154,43 @@ def report(dev):
 
 
 class OutputCustom:
-    def __init__(self, output):
+    def __init__(self, output, speed):
         self.output = output
+        self.speed = speed
 
-    def handle_usb(self, pkt, flags):
+    def handle_usb(self, ts, pkt, flags):
         pkthex = " ".join("%02x" % x for x in pkt)
-        self.output.write("data=%s speed=%s\n" % (pkthex, speed.upper()))
+        self.output.write("data=%s speed=%s\n" % (pkthex, self.speed.upper()))
+
+    def handle_batch(self, batch):
+        speed = self.speed.upper()
+        self.output.write("".join("data=%s speed=%s\n" % (
+            " ".join("%02x" % x for x in pkt), speed) for _, pkt, _ in batch))
 
 
 class OutputPcap:
     LINK_TYPE = 255 #FIXME
 
+    record_hdr = struct.Struct("IIIIH")
+
     def __init__(self, output):
         self.output = output
         self.output.write(struct.pack("IHHIIII", 0xa1b2c3d4, 2, 4, 0, 0, 1<<20, self.LINK_TYPE))
 
-    def handle_usb(self, pkt, flags):
-        self.output.write(struct.pack("IIIIH", 0, 0, len(pkt) + 2, len(pkt) + 2, flags))
+    def handle_usb(self, ts, pkt, flags):
+        self.output.write(self.record_hdr.pack(0, 0, len(pkt) + 2, len(pkt) + 2, flags))
         self.output.write(pkt)
 
+    def handle_batch(self, batch):
+        pack = self.record_hdr.pack
+
+        records = []
+        for _, pkt, flags in batch:
+            records.append(pack(0, 0, len(pkt) + 2, len(pkt) + 2, flags))
+            records.append(pkt)
+
+        self.output.write(b"".join(records))
+
 def do_sdramtests(dev, cb=None):
     
     for i in range(0,6):
@@ -175,15 +221,23 @@ def sdramtest(dev):
 
     dev.regs.LEDS_MUX_0.wr(0)
 
-@command('sniff', ('speed', str), ('format', str, 'verbose'), ('out', str, None), ('timeout', int, None))
-def sniff(dev, speed, format, out, timeout):
-    # LEDs off
-    dev.regs.LEDS_MUX_2.wr(0)
-    dev.regs.LEDS_OUT.wr(0)
+def link_utilization(dev):
+    st = dev.stats()
+    return "%8.3f MB/sec (%.3f average) %8d packets/sec %2d transfers in flight" % (
+            st.bytes_per_sec/1024/1024, st.avg_bytes_per_sec/1024/1024,
+            st.packets_per_sec, st.transfers_in_flight)
 
-    # LEDS 0/1 to FTDI TX/RX
-    dev.regs.LEDS_MUX_0.wr(2)
-    dev.regs.LEDS_MUX_1.wr(2)
+@command('sniff', ('speed', str), ('format', str, 'verbose'), ('out', str, None), ('timeout', int, None),
+        ('workers', int, 0), ('buffer', int, 1 << 16), ('ring', int, 0))
+def sniff(dev, speed, format, out, timeout, workers, buffer, ring):
+    with dev.posted():
+        # LEDs off
+        dev.regs.LEDS_MUX_2.wr(0)
+        dev.regs.LEDS_OUT.wr(0)
+
+        # LEDS 0/1 to FTDI TX/RX
+        dev.regs.LEDS_MUX_0.wr(2)
+        dev.regs.LEDS_MUX_1.wr(2)
 
     assert speed in ["hs", "fs", "ls"]
 
@@ -203,19 +257,46 @@ def sniff(dev, speed, format, out, timeout):
     else:
         assert 0,"Invalid Speed"
 
-    assert format in ["verbose", "custom", "pcap"]
+    assert format in ["verbose", "brief", "custom", "pcap"]
 
     output_handler = None
-    out = out and open(out, "wb")
-
-    if format == "custom":
-        output_handler = OutputCustom(out or sys.stdout)
+    out = out and open(out, "wb" if format == "pcap" else "w")
+
+    # Text is written out buffer characters at a time
+    sink = None
+    if format != "pcap":
+        sink = TextSink(out or sys.stdout, buffer)
+
+    if format == "verbose":
+        dev.rxcsniff.service.ui.output = sink
+    elif format == "brief":
+        # As verbose, without dumping the payloads
+        output_handler = USBInterpreter(dev.rxcsniff.service.highspeed, brief=True,
+                output=sink)
+    elif format == "custom":
+        output_handler = OutputCustom(sink, speed)
     elif format == "pcap":
         assert out, "can't output pcap to stdout, use --out"
         output_handler = OutputPcap(out)
 
     if output_handler is not None:
-      dev.rxcsniff.service.handlers = [output_handler.handle_usb]
+      dev.rxcsniff.service.handlers = [output_handler]
+
+    # Verbose decode can be spread over several processes
+    pipeline = None
+    if format == "verbose" and workers:
+        import decodepipe
+        pipeline = decodepipe.DecodePipeline(dev.rxcsniff.service.highspeed, workers,
+                output=sink)
+        dev.rxcsniff.service.handlers = [pipeline]
+
+    # As a flight recorder: only the last ring MB of capture is kept, and
+    # output once the capture stops
+    store = None
+    if ring:
+        store = LibOV.PacketStore(ring << 20)
+        handlers = dev.rxcsniff.service.handlers
+        dev.rxcsniff.service.handlers = [store]
 
     elapsed_time = 0
     try:
@@ -225,30 +306,100 @@ def sniff(dev, speed, format, out, timeout):
                 break
             time.sleep(1)
             elapsed_time = elapsed_time + 1
+            print(link_utilization(dev), file=sys.stderr)
     except KeyboardInterrupt:
         pass
     finally:
         dev.regs.CSTREAM_CFG.wr(0)
 
+        if store is not None:
+            batches = list(store.batches())
+            dev.rxcsniff.service.handlers = handlers
+            for batch in batches:
+                dev.rxcsniff.service.deliver(batch)
+
+            if store.evicted:
+                print("ring: %d older packets not kept" % store.evicted, file=sys.stderr)
+
+        if pipeline is not None:
+            pipeline.close()
+
+    if sink is not None:
+        sink.close()
+
     if out is not None:
         out.close()
 
+    st = dev.stats()
+    if st.resyncs:
+        print("stream lost sync %d times, %d bytes discarded, %d IO responses with bad checksums" % (
+            st.resyncs, st.discarded_bytes, st.bad_checksums), file=sys.stderr)
+
+    if dev.stream_queue is not None:
+        st = dev.stream_queue.stats()
+        print("stream queue: depth %d high-water %d dropped %d (%d bytes)" % (
+            st.depth, st.high_water, st.dropped, st.dropped_bytes), file=sys.stderr)
+
 @command('debug-stream')
 def debug_stream(dev):
-    cons = dev.regs.CSTREAM_CONS_LO.rd() | dev.regs.CSTREAM_CONS_HI.rd() << 8
-    prod_hd = dev.regs.CSTREAM_PROD_HD_LO.rd() | dev.regs.CSTREAM_PROD_HD_HI.rd() << 8
-    prod = dev.regs.CSTREAM_PROD_LO.rd() | dev.regs.CSTREAM_PROD_HI.rd() << 8
-    size = dev.regs.CSTREAM_SIZE_LO.rd() | dev.regs.CSTREAM_SIZE_HI.rd() << 8
+    r = dev.read_regs("CSTREAM_CONS", "CSTREAM_PROD_HD", "CSTREAM_PROD",
+            "CSTREAM_SIZE", "CSTREAM_PROD_STATE", "CSTREAM_LAST_START",
+            "CSTREAM_LAST_COUNT", "CSTREAM_LAST_PW")
 
-    state = dev.regs.CSTREAM_PROD_STATE.rd()
+    cons = r["CSTREAM_CONS"]
+    prod_hd = r["CSTREAM_PROD_HD"]
+    prod = r["CSTREAM_PROD"]
+    size = r["CSTREAM_SIZE"]
 
-    laststart = dev.regs.CSTREAM_LAST_START_LO.rd() | dev.regs.CSTREAM_LAST_START_HI.rd() << 8
-    lastcount = dev.regs.CSTREAM_LAST_COUNT_LO.rd() | dev.regs.CSTREAM_LAST_COUNT_HI.rd() << 8
-    lastpw = dev.regs.CSTREAM_LAST_PW_LO.rd() | dev.regs.CSTREAM_LAST_PW_HI.rd() << 8
+    state = r["CSTREAM_PROD_STATE"]
+
+    laststart = r["CSTREAM_LAST_START"]
+    lastcount = r["CSTREAM_LAST_COUNT"]
+    lastpw = r["CSTREAM_LAST_PW"]
 
     print("cons: %04x prod-wr: %04x prod-hd: %04x size: %04x state: %02x" % (cons, prod, prod_hd, size, state))
     print("\tlaststart: %04x lastcount: %04x (end: %04x) pw-at-write: %04x" % (laststart, lastcount, laststart + lastcount, lastpw))
 
+@command('io-bench', ('count', int, 4096), ('batch', int, 64))
+def io_bench(dev, count, batch):
+    addr = dev.resolve_addr("UCFG_STAT")
+
+    st = time.time()
+    for i in range(count):
+        dev.io.do_read(addr)
+    single = count / (time.time() - st)
+
+    st = time.time()
+    for i in range(0, count, batch):
+        dev.io.do_batch([(addr, None)] * min(batch, count - i))
+    batched = count / (time.time() - st)
+
+    print("%10.0f registers/sec one at a time" % single)
+    print("%10.0f registers/sec in batches of %d" % (batched, batch))
+
+@command('ulpi-bench', ('count', int, 1024))
+def ulpi_bench(dev, count):
+    if check_ulpi_clk(dev):
+        return
+
+    addr = dev.ulpiregs.scratch.addr
+
+    def rate(fn):
+        st = time.time()
+        for i in range(count):
+            fn(i)
+        return count / (time.time() - st)
+
+    results = [
+        ("read, polled", rate(lambda i: dev.ulpiread_polled(addr))),
+        ("read, pipelined", rate(lambda i: dev.ulpiread(addr))),
+        ("write, polled", rate(lambda i: dev.ulpiwrite_polled(addr, i & 0xFF))),
+        ("write, pipelined", rate(lambda i: dev.ulpiwrite(addr, i & 0xFF))),
+    ]
+
+    for name, r in results:
+        print("%10.0f accesses/sec %s" % (r, name))
+
 @command('ioread', ('addr', str))
 def ioread(dev, addr):
     print("%s: %02x" % (addr, dev.ioread(addr)))
@@ -278,21 +429,25 @@ class LB_Test(Command):
 
     @staticmethod
     def go(dev, args):
-        # Stop the generator - do twice to make sure
-        # theres no hanging packet 
-        dev.regs.RANDTEST_CFG.wr(0)
-        dev.regs.RANDTEST_CFG.wr(0)
+        with dev.posted():
+            # Stop the generator - do twice to make sure
+            # theres no hanging packet 
+            dev.regs.RANDTEST_CFG.wr(0)
+            dev.regs.RANDTEST_CFG.wr(0)
 
-        # LEDs off
-        dev.regs.LEDS_MUX_2.wr(0)
-        dev.regs.LEDS_OUT.wr(0)
+            # LEDs off
+            dev.regs.LEDS_MUX_2.wr(0)
+            dev.regs.LEDS_OUT.wr(0)
 
-        # LEDS 0/1 to FTDI TX/RX
-        dev.regs.LEDS_MUX_0.wr(2)
-        dev.regs.LEDS_MUX_1.wr(2)
+            # LEDS 0/1 to FTDI TX/RX
+            dev.regs.LEDS_MUX_0.wr(2)
+            dev.regs.LEDS_MUX_1.wr(2)
 
-        # Set test packet size
-        dev.regs.RANDTEST_SIZE.wr(args.size)
+            # Set test packet size
+            dev.regs.RANDTEST_SIZE.wr(args.size)
+
+        # The generator must have stopped before the counters are reset
+        dev.flush()
 
         # Reset the statistics counters
         dev.lfsrtest.reset()
@@ -300,19 +455,100 @@ class LB_Test(Command):
         # Start the test (and reinit the generator)
         dev.regs.RANDTEST_CFG.wr(1)
 
-        st = time.time()
         try:
             while 1:
                 time.sleep(1)
                 b = dev.lfsrtest.stats()
-                print("%4s %20d bytes %f MB/sec average" % (
+                print("%4s %20d bytes %s" % (
                     "ERR" if b.error else "OK", 
-                    b.total, b.total/float(time.time() - st)/1024/1024))
+                    b.total, link_utilization(dev)))
 
         except KeyboardInterrupt:
             dev.regs.randtest_cfg.wr(0)
 
 
+def measure_stream(dev, packetsPerTransfer, numTransfers, duration):
+    # Park the generator while the stream is switched over; anything in
+    # flight at that point is lost
+    dev.regs.RANDTEST_CFG.wr(0)
+    dev.set_stream_geometry(packetsPerTransfer, numTransfers)
+    time.sleep(0.5)
+
+    dev.lfsrtest.reset()
+    dev.regs.RANDTEST_CFG.wr(1)
+
+    # Skip the ramp up
+    time.sleep(0.2)
+
+    start = dev.lfsrtest.stats().total
+    st = time.time()
+    cpu_st = time.process_time()
+
+    time.sleep(duration)
+
+    b = dev.lfsrtest.stats()
+    mb = (b.total - start) / 1024 / 1024
+    elapsed = time.time() - st
+    cpu = time.process_time() - cpu_st
+
+    return mb / elapsed, cpu / mb if mb else float('inf'), b.error
+
+class TuneStream(Command):
+    name = "tune-stream"
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument("--duration", type=float, default=2.0,
+                help="seconds to measure each geometry for")
+        sp.add_argument("--size", type=int, default=255,
+                help="LFSR test packet size")
+        sp.add_argument("--packets-per-transfer", type=int, nargs='+',
+                default=[1, 2, 4, 8, 16, 32, 64])
+        sp.add_argument("--num-transfers", type=int, nargs='+',
+                default=[2, 4, 8, 16, 32, 64])
+        sp.add_argument("--dry-run", "-n", action="store_true",
+                help="don't save the best geometry to " + LibOV.HOST_CONFIG)
+
+    @staticmethod
+    def go(dev, args):
+        dev.regs.RANDTEST_CFG.wr(0)
+        dev.regs.RANDTEST_CFG.wr(0)
+        dev.regs.RANDTEST_SIZE.wr(args.size)
+
+        results = []
+        try:
+            for ppt in args.packets_per_transfer:
+                for nt in args.num_transfers:
+                    rate, cpu, error = measure_stream(dev, ppt, nt, args.duration)
+
+                    print("%4d x %-4d %4s %10.3f MB/sec %10.3f CPU sec/MB" % (
+                        ppt, nt, "ERR" if error else "OK", rate, cpu))
+
+                    if not error:
+                        results.append((rate, cpu, (ppt, nt)))
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            dev.regs.RANDTEST_CFG.wr(0)
+
+        if not results:
+            print("No error free geometry found")
+            return
+
+        # Of the geometries that get close to the best throughput, take the
+        # one that's cheapest on the CPU
+        best_rate = max(rate for rate, _, _ in results)
+        geometry = min((cpu, -rate, geometry)
+                for rate, cpu, geometry in results if rate >= 0.95 * best_rate)[2]
+
+        print("best: %d x %d" % geometry)
+
+        if not args.dry_run:
+            LibOV.save_stream_geometry(geometry)
+            print("saved to %s" % LibOV.HOST_CONFIG)
+
 def main():
 
     ap = argparse.ArgumentParser()
@@ -321,6 +557,10 @@ def main():
     ap.add_argument("-l", "--load", action="store_true")
     ap.add_argument("--verbose", "-v", action="store_true")
     ap.add_argument("--config-only", "-C", action="store_true")
+    ap.add_argument("--native-framing", action="store_true",
+            help="frame the stream in libov rather than in python")
+    ap.add_argument("--queue-depth", type=int, default=None,
+            help="decode the stream on its own thread, buffering this many transfers")
 
     # Bind commands
     subparsers = ap.add_subparsers()
@@ -332,7 +572,8 @@ def main():
     args = ap.parse_args()
 
 
-    dev = LibOV.OVDevice(mapfile=args.pkg.open('map.txt', 'r'), verbose=args.verbose)
+    dev = LibOV.OVDevice(mapfile=args.pkg.open('map.txt', 'r'), verbose=args.verbose,
+            native_framing=args.native_framing, queue_depth=args.queue_depth)
 
     err = dev.open(bitstream=args.pkg.open('ov3.bit', 'r') if args.load else None)
 
@@ -357,7 +598,7 @@ def main():
     if args.config_only:
         return
 
-    dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async=False)
+    dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async_=False)
 
     try:
         if hasattr(args, 'hdlr'):
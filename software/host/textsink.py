@@ -0,0 +1,93 @@
+# Buffered text output for packet decoders
+#
+# Printing each decoded packet costs a write per line once the output's own
+# buffering is line based (a terminal), and even block buffered it costs a
+# call into the io stack per line. TextSink takes lines a batch at a time
+# and hands them on in large writes: once buffer_size characters are
+# pending, or flush_interval seconds after the first of them arrived, so
+# light traffic still shows up promptly when watching interactively.
+
+import atexit
+import sys
+import threading
+import weakref
+
+# Sinks still open, flushed at exit. Held weakly so a sink, and the
+# decoder it belongs to, can go away without being closed.
+_sinks = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for sink in list(_sinks):
+        sink.flush()
+
+class TextSink:
+    """File-like sink for decoded text. output is written to on flushes, and
+    defaults to whatever sys.stdout is at the time. buffer_size 0 writes
+    everything straight through; flush_interval None disables the timer."""
+
+    def __init__(self, output=None, buffer_size=1 << 16, flush_interval=0.1):
+        self.output = output
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self.pending = []
+        self.size = 0
+
+        # Written to from the capture thread, flushed from the timer's
+        self.lock = threading.Lock()
+        self.timer = None
+
+        _sinks.add(self)
+
+    def write(self, text):
+        self.writelines((text,))
+
+    def writelines(self, lines):
+        """Buffer lines, which like file.writelines() include their own
+        newlines. Meant to be called once per batch of packets."""
+        text = "".join(lines)
+        if not text:
+            return
+
+        with self.lock:
+            self.pending.append(text)
+            self.size += len(text)
+
+            if self.size >= self.buffer_size:
+                self.__flush()
+            elif self.timer is None and self.flush_interval is not None:
+                self.timer = threading.Timer(self.flush_interval, self.__expire)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def __expire(self):
+        with self.lock:
+            self.timer = None
+            self.__flush()
+
+    def __flush(self):
+        if not self.pending:
+            return
+
+        output = self.output or sys.stdout
+        output.writelines(self.pending)
+        output.flush()
+
+        self.pending = []
+        self.size = 0
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def close(self):
+        """Flush, and stop the timer. Doesn't close output."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            self.__flush()
+
+        _sinks.discard(self)
@@ -1,7 +1,9 @@
+#include <stdarg.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
-#include "fastftdi.h"
+#include <sys/time.h>
+#include "usb_interp.h"
 
 
 enum {
@@ -69,6 +71,92 @@ enum {
   CRC_NONE = 3,
 };
 
+/*
+ * Text output - see usb_interp.h. Lines collect in our own buffer rather
+ * than stdout's, since setvbuf may only be called before the first output
+ * to a stream. The flush interval is checked per packet and on
+ * CStreamCallback's periodic progress calls, so lines don't sit in the
+ * buffer while traffic is light.
+ */
+static char *text_buf;
+static size_t text_size, text_len;
+static unsigned char text_unbuffered = 0;
+static unsigned int text_flush_ms = 100;
+static struct timeval text_last_flush;
+
+static void text_flush(void) {
+  if (text_len) {
+    fwrite(text_buf, 1, text_len, stdout);
+    text_len = 0;
+  }
+  fflush(stdout);
+}
+
+static void text_write(const char *s, size_t len) {
+  if (text_len + len > text_size)
+    text_flush();
+
+  if (len > text_size) {
+    fwrite(s, 1, len, stdout);
+    if (text_unbuffered)
+      fflush(stdout);
+    return;
+  }
+
+  memcpy(text_buf + text_len, s, len);
+  text_len += len;
+}
+
+static void text_printf(const char *fmt, ...) {
+  char line[4096];
+  va_list ap;
+  int len;
+
+  va_start(ap, fmt);
+  len = vsnprintf(line, sizeof line, fmt, ap);
+  va_end(ap);
+
+  if (len < 0)
+    return;
+  if (len >= sizeof line)
+    len = sizeof line - 1;
+
+  text_write(line, len);
+}
+
+int OV_SetTextBuffer(size_t size, unsigned int flush_ms) {
+  char *buf = NULL;
+
+  if (size) {
+    buf = malloc(size);
+    if (!buf)
+      return -1;
+  }
+
+  text_flush();
+
+  free(text_buf);
+  text_buf = buf;
+  text_size = size;
+  text_unbuffered = !size;
+  text_flush_ms = flush_ms;
+  return 0;
+}
+
+static void text_poll(void) {
+  struct timeval now;
+
+  if (!text_flush_ms)
+    return;
+
+  gettimeofday(&now, NULL);
+  if ((now.tv_sec - text_last_flush.tv_sec) * 1000 +
+      (now.tv_usec - text_last_flush.tv_usec) / 1000 >= text_flush_ms) {
+    text_flush();
+    text_last_flush = now;
+  }
+}
+
 int frameno;
 int subframe;
 unsigned char highspeed = 1;
@@ -99,12 +187,7 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
   }
   ts += ts_base;
 
-  if (flags & 0x20) flag_field[3] = 'L';
-  if (flags & 0x10) flag_field[4] = 'F';
-  if (flags & 0x08) flag_field[5] = 'T';
-  if (flags & 0x04) flag_field[6] = 'C';
-  if (flags & 0x02) flag_field[7] = 'O';
-  if (flags & 0x01) flag_field[8] = 'E';
+  suppress = 0;
 
   if (len == 0) {
     //    printf("Error: zero-len buf?\n");
@@ -118,8 +201,6 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
     goto done;
   }
 
-  suppress = 0;
-
   switch(pid) {
   case 0x5: {
     unsigned char frame;
@@ -154,14 +235,9 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
     
     frameno = frame;
     last_ts_frame = ts;
+
+    // Complete SOFs aren't printed, so there's nothing to format
     suppress = 1;
-    snprintf(msg + strlen(msg), sizeof(msg)-strlen(msg),
-	     "Frame %d.", frame);
-    if (subframe == -1) 
-      strcat(msg, "?");
-    else
-      snprintf(msg + strlen(msg), sizeof(msg)-strlen(msg),
-	       "%d", subframe);
     break;
   }
   case 0x3: // DATA0
@@ -169,7 +245,9 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
   case 0x7: // DATA2
     sprintf(msg, "%s:", names[pid]); // fixme pid->DATA mapping
     hd(msg + strlen(msg), sizeof msg - strlen(msg), buf + 1, len - 1);
-    // fixme CRC check
+    if (len > 2 &&
+        OV_CRC16(buf + 1, len - 3) != (buf[len - 2] | buf[len - 1] << 8))
+      strncat(msg, "\tUnexpected ERR CRC", sizeof msg - strlen(msg) - 1);
     break;
     
   case 0xF: // MDATA
@@ -217,7 +295,14 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
   
  done:
   if (suppress) return;
-  
+
+  if (flags & 0x20) flag_field[3] = 'L';
+  if (flags & 0x10) flag_field[4] = 'F';
+  if (flags & 0x08) flag_field[5] = 'T';
+  if (flags & 0x04) flag_field[6] = 'C';
+  if (flags & 0x02) flag_field[7] = 'O';
+  if (flags & 0x01) flag_field[8] = 'E';
+
   delta_subframe = ts - last_ts_frame;
   delta_print = ts - last_ts_print;
   last_ts_print = ts;
@@ -232,8 +317,9 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
 	   flag_field, ts/RATE, delta_print/RATE,
 	   frame_print, subf_print, delta_subframe/RATE * 1E6, len);
   
-  printf("%s %s**\n", header, msg);
+  text_printf("%s %s**\n", header, msg);
   //  hexdump(buf, len);
+  text_poll();
 }
 
 unsigned char got_start = 0;
@@ -241,8 +327,10 @@ unsigned char got_start = 0;
 int CStreamCallback (uint8_t *buffer, int length,
 			FTDIProgressInfo *progress, void *userdata) {
   unsigned char *p;
-  if (!buffer ||  !length) 
+  if (!buffer ||  !length) {
+    text_poll();
     return 0;
+  }
   //    printf("CStreamCallback(%p, %d, %p, %p)\n", buffer, length, progress, userdata);
   //  hexdump(buffer, length);
   FTDIStreamCallback *cb = (FTDIStreamCallback *)userdata;
@@ -252,7 +340,8 @@ int CStreamCallback (uint8_t *buffer, int length,
   packet_buf_len += length;
   p = packet_buf;
   if (packet_buf_len > sizeof packet_buf) {
-    printf("ERROR: buffer overflow\n");
+    text_printf("ERROR: buffer overflow\n");
+    text_flush();
     exit(0);
   }
   
@@ -261,7 +350,7 @@ int CStreamCallback (uint8_t *buffer, int length,
     switch(p[0]) {
     case 0x55:
       if (packet_buf_len < 5) {
-	printf("IO packet error -- too short (%d < 5)\n", packet_buf_len);
+	text_printf("IO packet error -- too short (%d < 5)\n", packet_buf_len);
 	packet_buf_len--;
 	p++;
 	break;
@@ -272,7 +361,7 @@ int CStreamCallback (uint8_t *buffer, int length,
       break;
     case 0xAA:
       if (packet_buf_len < 2) {
-	printf("LFSR packet error -- too short (%d < 2)\n", packet_buf_len);
+	text_printf("LFSR packet error -- too short (%d < 2)\n", packet_buf_len);
 	packet_buf_len--;
 	p++;
 	break;
@@ -289,7 +378,7 @@ int CStreamCallback (uint8_t *buffer, int length,
 	unsigned int pktsize = p[3] | (p[4] << 8) + 8;
 	unsigned int ts = p[5] | (p[6] << 8) | (p[7] << 16);
 	if (flags !=0) {
-	  printf("PERR: %04X\n", flags);
+	  text_printf("PERR: %04X\n", flags);
 	}
 	//	printf("Packet flags=%04x size=%04x ts=%06x\n", flags, pktsize, ts);
 	if (packet_buf_len < pktsize) {
@@ -308,7 +397,7 @@ int CStreamCallback (uint8_t *buffer, int length,
       }
       break;
     default:
-      printf("Unknown packet byte %02x, discarding\n", p[0]);
+      text_printf("Unknown packet byte %02x, discarding\n", p[0]);
       p++;
       packet_buf_len--;
       break;
@@ -319,3 +408,349 @@ int CStreamCallback (uint8_t *buffer, int length,
   memmove(packet_buf, p, packet_buf_len);
   return 0;
 }
+
+
+/*
+ * Native stream framing - see usb_interp.h
+ */
+
+// Largest capture packet the gateware emits (ovhw/whacker/producer.py)
+#define OV_MAX_PACKET_SIZE 800
+
+// Every HF0_* capture flag
+#define OV_HF0_MASK 0x3F
+
+// Back to back plausible messages needed to resynchronize on
+#define OV_RESYNC_CONFIRM 3
+
+struct OVFramer {
+  OVBatchCallback *callback;
+  void *userdata;
+
+  // Unframed data: the tail carried over from the last transfer, followed
+  // by the new one
+  uint8_t *buf;
+  int len;
+  int size;
+
+  // Descriptor columns, sized for the worst case of one message per 2 bytes
+  int maxCount;
+  uint8_t  *magic;
+  uint32_t *offset;
+  uint16_t *length;
+  uint16_t *flags;
+  uint32_t *ts;
+
+  uint64_t discarded;
+  uint64_t resyncs;
+  uint64_t badChecksums;
+  int lostSync;
+};
+
+static int OVFramer_Reserve(OVFramer *f, int len) {
+  if (len > f->size) {
+    uint8_t *buf = realloc(f->buf, len);
+    if (!buf)
+      return LIBUSB_ERROR_NO_MEM;
+    f->buf = buf;
+    f->size = len;
+  }
+
+  if (len / 2 > f->maxCount) {
+    int n = len / 2;
+    uint8_t *magic = realloc(f->magic, n * sizeof *f->magic);
+    uint32_t *offset = realloc(f->offset, n * sizeof *f->offset);
+    uint16_t *length = realloc(f->length, n * sizeof *f->length);
+    uint16_t *flags = realloc(f->flags, n * sizeof *f->flags);
+    uint32_t *ts = realloc(f->ts, n * sizeof *f->ts);
+
+    // realloc leaves the old block alone on failure, so keep whatever
+    // succeeded and just don't grow maxCount
+    if (magic) f->magic = magic;
+    if (offset) f->offset = offset;
+    if (length) f->length = length;
+    if (flags) f->flags = flags;
+    if (ts) f->ts = ts;
+
+    if (!magic || !offset || !length || !flags || !ts)
+      return LIBUSB_ERROR_NO_MEM;
+
+    f->maxCount = n;
+  }
+
+  return 0;
+}
+
+OVFramer *OVFramer_New(OVBatchCallback *callback, void *userdata) {
+  OVFramer *f = calloc(1, sizeof *f);
+  if (!f)
+    return NULL;
+
+  f->callback = callback;
+  f->userdata = userdata;
+
+  if (OVFramer_Reserve(f, 16384)) {
+    OVFramer_Free(f);
+    return NULL;
+  }
+
+  return f;
+}
+
+void OVFramer_Free(OVFramer *f) {
+  if (!f)
+    return;
+
+  free(f->buf);
+  free(f->magic);
+  free(f->offset);
+  free(f->length);
+  free(f->flags);
+  free(f->ts);
+  free(f);
+}
+
+uint64_t OVFramer_GetDiscarded(OVFramer *f) {
+  return f->discarded;
+}
+
+uint64_t OVFramer_GetResyncs(OVFramer *f) {
+  return f->resyncs;
+}
+
+uint64_t OVFramer_GetBadChecksums(OVFramer *f) {
+  return f->badChecksums;
+}
+
+/*
+ * Size of the message at p, 0 if its header is implausible (or p doesn't
+ * start a message at all), or -1 if more than avail bytes are needed to
+ * tell.
+ */
+static int OVFramer_MessageSize(const uint8_t *p, int avail) {
+  int size;
+
+  switch (p[0]) {
+  case 0x55:
+    if (avail < 5)
+      return -1;
+    if (((p[0] + p[1] + p[2] + p[3]) & 0xFF) != p[4])
+      return 0;
+    return 5;
+
+  case 0xAA:
+    if (avail < 2)
+      return -1;
+    return p[1] + 2;
+
+  case 0xA0:
+    if (avail < 8)
+      return -1;
+    size = p[3] | (p[4] << 8);
+    // A header this far off can only be noise
+    if (size > OV_MAX_PACKET_SIZE || p[2] || (p[1] & ~OV_HF0_MASK))
+      return 0;
+    return size + 8;
+
+  case 0xAC:
+  case 0xAD:
+    return 2;
+
+  default:
+    return 0;
+  }
+}
+
+/*
+ * Having lost sync, is p the start of a run of OV_RESYNC_CONFIRM plausible
+ * messages? 1 if so, 0 if not, -1 if more data is needed to tell.
+ */
+static int OVFramer_ConfirmSync(const uint8_t *p, const uint8_t *end) {
+  int i;
+
+  for (i = 0; i < OV_RESYNC_CONFIRM; i++) {
+    int size = OVFramer_MessageSize(p, end - p);
+
+    if (size == 0)
+      return 0;
+
+    // Anything cut short is only good enough once it's been followed up by
+    // something else
+    if (size < 0 || p + size > end)
+      return i == 0 ? -1 : 1;
+
+    p += size;
+    if (p == end)
+      return 1;
+  }
+
+  return 1;
+}
+
+int OVFramer_StreamCallback(uint8_t *buffer, int length,
+                            FTDIProgressInfo *progress, void *userdata) {
+  OVFramer *f = userdata;
+  OVPacketBatch batch;
+  uint8_t *p, *end;
+  int count = 0;
+  int ret, err;
+
+  if (!buffer || !length)
+    return f->callback(NULL, progress, f->userdata);
+
+  if ((err = OVFramer_Reserve(f, f->len + length)))
+    return err;
+
+  memcpy(f->buf + f->len, buffer, length);
+  f->len += length;
+
+  p = f->buf;
+  end = f->buf + f->len;
+
+  while (p < end) {
+    int size;
+
+    if (f->lostSync) {
+      int found = OVFramer_ConfirmSync(p, end);
+
+      if (found < 0)
+        goto done;
+
+      if (!found) {
+        f->discarded++;
+        p++;
+        continue;
+      }
+
+      f->lostSync = 0;
+    }
+
+    size = OVFramer_MessageSize(p, end - p);
+
+    if (size < 0 || p + size > end)
+      goto done;
+
+    if (size == 0) {
+      // Most likely a symptom of lost sync, but a corrupt register read
+      // reply would otherwise just time out
+      if (p[0] == 0x55)
+        f->badChecksums++;
+      f->resyncs++;
+      f->lostSync = 1;
+      continue;
+    }
+
+    switch (p[0]) {
+    case 0xA0:
+      f->magic[count] = 0xA0;
+      f->offset[count] = p + 8 - f->buf;
+      f->length[count] = size - 8;
+      f->flags[count] = p[1] | (p[2] << 8);
+      f->ts[count] = p[5] | (p[6] << 8) | (p[7] << 16);
+      count++;
+      break;
+
+    case 0xAC:
+    case 0xAD:
+      break;
+
+    default:
+      f->magic[count] = p[0];
+      f->offset[count] = p - f->buf;
+      f->length[count] = size;
+      f->flags[count] = 0;
+      f->ts[count] = 0;
+      count++;
+      break;
+    }
+
+    p += size;
+  }
+
+ done:
+  ret = 0;
+
+  if (count) {
+    batch.count = count;
+    batch.magic = f->magic;
+    batch.offset = f->offset;
+    batch.length = f->length;
+    batch.flags = f->flags;
+    batch.ts = f->ts;
+    batch.payload = f->buf;
+    batch.payloadLength = p - f->buf;
+
+    ret = f->callback(&batch, progress, f->userdata);
+  }
+
+  f->len = end - p;
+  memmove(f->buf, p, f->len);
+
+  return ret;
+}
+
+
+/*
+ * Slicing-by-8 CRC16: crc16_table[k][b] is the CRC of byte b followed by k
+ * zero bytes, so eight bytes can be folded in per step.
+ */
+
+static uint16_t crc16_table[8][256];
+
+__attribute__((constructor))
+static void OV_CRC16_Init(void) {
+  for (int i = 0; i < 256; i++) {
+    uint16_t crc = i;
+    for (int bit = 0; bit < 8; bit++)
+      crc = crc & 1 ? (crc >> 1) ^ 0xA001 : crc >> 1;
+    crc16_table[0][i] = crc;
+  }
+
+  for (int k = 1; k < 8; k++)
+    for (int i = 0; i < 256; i++) {
+      uint16_t prev = crc16_table[k - 1][i];
+      crc16_table[k][i] = (prev >> 8) ^ crc16_table[0][prev & 0xFF];
+    }
+}
+
+uint16_t OV_CRC16(const uint8_t *p, size_t length) {
+  uint16_t crc = 0xFFFF;
+
+  while (length >= 8) {
+    crc ^= p[0] | p[1] << 8;
+    crc = crc16_table[7][crc & 0xFF] ^ crc16_table[6][crc >> 8] ^
+          crc16_table[5][p[2]] ^ crc16_table[4][p[3]] ^
+          crc16_table[3][p[4]] ^ crc16_table[2][p[5]] ^
+          crc16_table[1][p[6]] ^ crc16_table[0][p[7]];
+    p += 8;
+    length -= 8;
+  }
+
+  while (length--)
+    crc = (crc >> 8) ^ crc16_table[0][(crc ^ *p++) & 0xFF];
+
+  return crc ^ 0xFFFF;
+}
+
+int OV_CheckDataCRC(const uint8_t *payload, const uint32_t *offset,
+                    const uint16_t *length, int count, uint8_t *result) {
+  int bad = 0;
+
+  for (int i = 0; i < count; i++) {
+    const uint8_t *p = payload + offset[i];
+    int len = length[i];
+
+    result[i] = 1;
+
+    // DATA0, DATA1 and DATA2, with a valid PID
+    if (len <= 2 || (p[0] != 0xC3 && p[0] != 0x4B && p[0] != 0x87))
+      continue;
+
+    if (OV_CRC16(p + 1, len - 3) != (p[len - 2] | p[len - 1] << 8)) {
+      result[i] = 0;
+      bad++;
+    }
+  }
+
+  return bad;
+}
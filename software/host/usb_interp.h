@@ -0,0 +1,83 @@
+#ifndef __USB_INTERP_H
+#define __USB_INTERP_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include "fastftdi.h"
+
+/*
+ * Native stream framing
+ *
+ * OVFramer splits the FTDI byte stream into the 0x55 (IO), 0xAA (LFSR test)
+ * and 0xA0 (capture) messages, and hands them to its callback in one batch
+ * per libusb transfer. Message i of a batch starts at payload + offset[i]
+ * and is length[i] bytes long. For capture packets the 8 byte header has
+ * already been parsed into flags[i] and ts[i], and offset/length cover just
+ * the packet data; other messages are passed whole, header included.
+ *
+ * The batch is only valid for the duration of the callback.
+ */
+
+typedef struct {
+  int count;
+  uint8_t  *magic;
+  uint32_t *offset;
+  uint16_t *length;
+  uint16_t *flags;
+  uint32_t *ts;
+  uint8_t  *payload;
+  int payloadLength;
+} OVPacketBatch;
+
+// batch is NULL for the periodic progress callbacks
+typedef int (OVBatchCallback)(OVPacketBatch *batch, FTDIProgressInfo *progress,
+                              void *userdata);
+
+typedef struct OVFramer OVFramer;
+
+OVFramer *OVFramer_New(OVBatchCallback *callback, void *userdata);
+void OVFramer_Free(OVFramer *framer);
+uint64_t OVFramer_GetDiscarded(OVFramer *framer);
+uint64_t OVFramer_GetResyncs(OVFramer *framer);
+uint64_t OVFramer_GetBadChecksums(OVFramer *framer);
+
+// FTDIStreamCallback to be used with FTDI_STREAM_COALESCE, userdata is the
+// OVFramer
+int OVFramer_StreamCallback(uint8_t *buffer, int length,
+                            FTDIProgressInfo *progress, void *userdata);
+
+/*
+ * USB data packet CRC16
+ *
+ * OV_CRC16 returns the CRC16 of length bytes as it would appear in the
+ * packet: reflected 0x8005, initial value 0xFFFF, inverted.
+ *
+ * OV_CheckDataCRC checks a whole batch of packets, packet i being
+ * length[i] bytes at payload + offset[i] (as in OVPacketBatch).
+ * result[i] is set to 0 if packet i is a DATA0/1/2 packet whose CRC16
+ * doesn't match, and to 1 otherwise. Returns the number of bad packets.
+ */
+
+uint16_t OV_CRC16(const uint8_t *data, size_t length);
+int OV_CheckDataCRC(const uint8_t *payload, const uint32_t *offset,
+                    const uint16_t *length, int count, uint8_t *result);
+
+/*
+ * ChandlePacket's text output
+ *
+ * Lines are collected in a buffer of size bytes, set by OV_SetTextBuffer,
+ * and written to stdout with fwrite once it fills up (0 writes and flushes
+ * every line). Whatever the buffering, pending lines are written and
+ * stdout flushed once flush_ms has passed since the last flush (0 to leave
+ * it to the buffer). The default is no buffer of our own, leaving lines to
+ * stdio's buffering, flushed every 100ms. stdout's own buffering is never
+ * changed, so this may be called at any time. Returns 0 on success.
+ */
+
+int OV_SetTextBuffer(size_t size, unsigned int flush_ms);
+
+void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf, unsigned int len);
+int CStreamCallback(uint8_t *buffer, int length,
+                    FTDIProgressInfo *progress, void *userdata);
+
+#endif /* __USB_INTERP_H */
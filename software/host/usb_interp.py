@@ -1,15 +1,79 @@
+import collections
+
+from textsink import TextSink
 
 def hd(x):
     return " ".join("%02x" % i for i in x)
 
+def crc5(v):
+    """USB token CRC5 of the 11 bit value v"""
+    crc = 0x1F
+    for i in range(11):
+        if (crc ^ (v >> i)) & 1:
+            crc = (crc >> 1) ^ 0x14
+        else:
+            crc >>= 1
+
+    return crc ^ 0x1F
+
+# Packet kinds, as far as decoding them goes
+PID_TOKEN, PID_SOF, PID_DATA, PID_MDATA, PID_OTHER = range(5)
+
+_PIDS = {
+    0x1: ("OUT", PID_TOKEN),
+    0x9: ("IN", PID_TOKEN),
+    0xD: ("SETUP", PID_TOKEN),
+    0x4: ("PING", PID_TOKEN),
+    0x5: ("SOF", PID_SOF),
+    0x3: ("DATA0", PID_DATA),
+    0xB: ("DATA1", PID_DATA),
+    0x7: ("DATA2", PID_DATA),
+    0xF: ("MDATA", PID_MDATA),
+    0x2: ("ACK", PID_OTHER),
+    0xA: ("NAK", PID_OTHER),
+    0xE: ("STALL", PID_OTHER),
+    0x6: ("NYET", PID_OTHER),
+    0xC: ("PRE-ERR", PID_OTHER),
+    0x8: ("SPLIT", PID_OTHER),
+    0x0: ("WUT", PID_OTHER),
+}
+
+# PID byte -> (valid, name, kind). The PID is valid if the high nibble is
+# the complement of the low one.
+PID_TABLE = [((b >> 4) ^ 0xF == b & 0xF,) + _PIDS[b & 0xF] for b in range(256)]
+
+_CRC5 = [crc5(i) for i in range(2048)]
+_tok_ok = [(i & 0x7F, i >> 7, True) for i in range(2048)]
+_tok_bad = [(i & 0x7F, i >> 7, False) for i in range(2048)]
+
+# The two bytes after a token's PID, as buf[1] | buf[2] << 8 ->
+# (addr, endp, crc5_ok). For SOFs the 11 bit frame number is
+# addr | endp << 7.
+TOKEN_TABLE = [(_tok_ok if _CRC5[i & 0x7FF] == i >> 11 else _tok_bad)[i & 0x7FF]
+        for i in range(65536)]
+
+# A decoded packet. Decoding only fills these in; the text is made by
+# USBInterpreter.format_record(), and only for records that get printed.
+# pid is the PID byte, None for an empty packet. addr and endp are set for
+# complete tokens and SOFs, for which crc_ok is the CRC5 result; for DATA
+# packets it's the CRC16 result if already checked, else None. buf is the
+# packet data as captured.
+PacketRecord = collections.namedtuple("PacketRecord", [
+    'ts', 'delta_print', 'frameno', 'subframe', 'delta_subframe',
+    'flags', 'pid', 'addr', 'endp', 'crc_ok', 'buf'])
+
 class USBInterpreter(object):
     import crcmod
     data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
 
-    def __init__(self, highspeed):
+    # brief leaves the payload out of DATA packets, giving its length
+    # instead. Lines are written to output, by default a TextSink on stdout.
+    def __init__(self, highspeed, brief=False, output=None):
         self.frameno = None
         self.subframe = 0
         self.highspeed = True
+        self.brief = brief
+        self.output = output if output is not None else TextSink()
 
         self.last_ts_frame = 0
 
@@ -19,11 +83,45 @@ class USBInterpreter(object):
         self.ts_roll_cyc = 2**24
 
     def handlePacket(self, ts, buf, flags):
-        CRC_BAD = 1
-        CRC_GOOD = 2
-        CRC_NONE = 3
-        crc_check = CRC_NONE
-        
+        rec = self.decode(ts, buf, flags)
+
+        if rec is not None:
+            self.output.write(self.format_record(rec) + "\n")
+
+    def handle_batch(self, batch):
+        format_record = self.format_record
+
+        self.output.writelines([format_record(rec) + "\n"
+                for rec in self.decode_batch(batch)])
+
+    def decode(self, ts, buf, flags, crc_ok=None):
+        """The PacketRecord for a packet, or None if it isn't to be printed"""
+        ctx = self.sequence(ts, buf, flags)
+        if ctx is None:
+            return None
+
+        return self.record(ctx, buf, flags, crc_ok)
+
+    def decode_batch(self, batch):
+        """PacketRecords for the packets of a PacketBatch that are to be
+        printed, the data CRCs checked a batch at a time"""
+        sequence = self.sequence
+        record = self.record
+
+        records = []
+        for (ts, buf, flags), crc_ok in zip(batch, batch.check_crc()):
+            ctx = sequence(ts, buf, flags)
+            if ctx is not None:
+                records.append(record(ctx, buf, flags, crc_ok))
+
+        return records
+
+    # Decoding is split in two so the expensive half can run out of order
+    # (see decodepipe.py). sequence() must see every packet, in order: it
+    # extends the timestamp, tracks frame numbers and returns the context
+    # record() and format() need, or None if the packet isn't to be printed.
+    # Those depend on nothing but their arguments.
+    def sequence(self, ts, buf, flags):
         ts_delta_pkt = ts - self.last_ts_pkt
         self.last_ts_pkt = ts
 
@@ -32,121 +130,125 @@ class USBInterpreter(object):
 
         ts += self.ts_base
 
+        if len(buf) >= 3 and buf[0] == 0xA5:
+            addr, endp, crc_ok = TOKEN_TABLE[buf[1] | buf[2] << 8]
 
-        suppress = False
-
-        #msg = "(%s)" % " ".join("%02x" % i for i in buf)
-        msg = ""
+            # A corrupt SOF is printed rather than trusted
+            if not crc_ok:
+                return self.__context(ts)
 
-        if len(buf) != 0:
-            pid = buf[0] & 0xF
-            if (buf[0] >> 4) ^ 0xF != pid:
-                msg += "Err - bad PID of %02x" % pid
-            elif pid == 0x5:
-                if len(buf) < 3:
-                    msg += "RUNT frame"
+            frameno = addr | endp << 7
+            if self.frameno == None:
+                self.subframe = None
+            else:
+                if self.subframe == None:
+                    if frameno == (self.frameno + 1) & 0x7FF:
+                        self.subframe = 0 if self.highspeed else None
                 else:
-                    frameno = buf[1] | (buf[2] << 8) & 0x7
-                    if self.frameno == None:
-                        self.subframe = None
-                    else:
-                        if self.subframe == None:
-                            if frameno == (self.frameno + 1) & 0xFF:
-                                self.subframe = 0 if self.highspeed else None
+                    self.subframe += 1
+                    if self.subframe == 8:
+                        if frameno == (self.frameno + 1) & 0x7FF:
+                            self.subframe = 0
                         else:
-                            self.subframe += 1
-                            if self.subframe == 8:
-                                if frameno == (self.frameno + 1)&0xFF:
-                                    self.subframe = 0
-                                else:
-                                    msg += "WTF Subframe %d" % self.frameno
-                                    self.subframe = None
-                            elif self.frameno != frameno:
-                                msg += "WTF frameno %d" % self.frameno
-                                self.subframe = None
-                    
-                    self.frameno = frameno
-                                
-                    self.last_ts_frame = ts
-                    suppress = True
-                    msg += "Frame %d.%c" % (frameno, '?' if self.subframe == None else "%d" % self.subframe)
-            elif pid in [0x3, 0xB, 0x7]:
-                n = {3:0, 0xB:1, 0x7:2}[pid]
-
-                msg += "DATA%d: %s" % (n,hd(buf[1:]))
-
-                if len(buf) > 2:
-                    calc_check = self.data_crc(buf[1:-2])^0xFFFF 
-                    pkt_check = buf[-2] | buf[-1] << 8
-
-                    if calc_check != pkt_check:
-                        msg += "\tUnexpected ERR CRC"
-
-            elif pid == 0xF:
-                msg += "MDATA: %s" % hd(buf[1:])
-            elif pid in [0x01, 0x09, 0x0D, 0x04]:
-                if pid == 1:
-                    name = "OUT"
-                elif pid == 9:
-                    name = "IN"
-                elif pid == 0xD:
-                    name = "SETUP"
-                elif pid == 0x04:
-                    name = "PING"
-                if len(buf) < 3:
-                    msg += "RUNT: %s %s" % (name, " ".join("%02x" % i for i in buf))
-                else:
+                            self.subframe = None
+                    elif self.frameno != frameno:
+                        self.subframe = None
+            
+            self.frameno = frameno
+                        
+            self.last_ts_frame = ts
+            return None
+
+        return self.__context(ts)
+
+    def __context(self, ts):
+        delta_subframe = ts - self.last_ts_frame
+        delta_print = ts - self.last_ts_print
+        self.last_ts_print = ts
+
+        return (ts, delta_print, self.frameno, self.subframe, delta_subframe)
 
-                    addr = buf[1] & 0x7F
-                    endp = (buf[2] & 0x7) << 1 | buf[1] >> 7
-
-                    msg += "%-5s: %d.%d" % (name, addr, endp)
-            elif pid == 2:
-                msg += "ACK"
-            elif pid == 0xA:
-                msg += "NAK"
-            elif pid == 0xE:
-                msg += "STALL"
-            elif pid == 0x6:
-                msg += "NYET"
-            elif pid == 0xC:
-                msg += "PRE-ERR"
-                pass
-            elif pid == 0x8:
-                msg += "SPLIT"
-                pass
+    def record(self, ctx, buf, flags, crc_ok=None):
+        pid = addr = endp = None
+
+        if buf:
+            pid = buf[0]
+            valid, _, kind = PID_TABLE[pid]
+            if valid and len(buf) >= 3 and (kind == PID_TOKEN or kind == PID_SOF):
+                addr, endp, crc_ok = TOKEN_TABLE[buf[1] | buf[2] << 8]
+
+        return PacketRecord(*ctx, flags, pid, addr, endp, crc_ok, buf)
+
+    # The packet itself, minus timing and flags
+    def describe(self, rec):
+        buf = rec.buf
+        if not buf:
+            return ""
+
+        msg = ""
+
+        valid, name, kind = PID_TABLE[rec.pid]
+        if not valid:
+            msg += "Err - bad PID of %02x" % (rec.pid & 0xF)
+        elif kind == PID_TOKEN:
+            if rec.addr is None:
+                msg += "RUNT: %s %s" % (name, hd(buf))
+            else:
+                msg += "%-5s: %d.%d" % (name, rec.addr, rec.endp)
+                if not rec.crc_ok:
+                    msg += "\tUnexpected ERR CRC5"
+        elif kind == PID_DATA or kind == PID_MDATA:
+            if self.brief:
+                msg += "%s: %d bytes" % (name, len(buf) - 1)
+            else:
+                msg += "%s: %s" % (name, hd(buf[1:]))
+
+            if kind == PID_DATA and len(buf) > 2:
+                crc_ok = rec.crc_ok
+                if crc_ok is None:
+                    crc_ok = self.data_crc(buf[1:-2]) ^ 0xFFFF == buf[-2] | buf[-1] << 8
+
+                if not crc_ok:
+                    msg += "\tUnexpected ERR CRC"
+
+        elif kind == PID_SOF:
+            # Complete SOFs are only printed if corrupt
+            if rec.addr is None:
+                msg += "RUNT frame"
             else:
-                msg += "WUT"
-
-        if not suppress:
-            crc_char_d = {
-                CRC_BAD: '!',
-                CRC_GOOD: 'C',
-                CRC_NONE: ' '
-            }
-
-            flag_field = "[  %s%s%s%s%s%s]" % (
-                'L' if flags & 0x20 else ' ',
-                'F' if flags & 0x10 else ' ',
-                'T' if flags & 0x08 else ' ',
-                'C' if flags & 0x04 else ' ',
-                'O' if flags & 0x02 else ' ',
-                'E' if flags & 0x01 else ' ')
-            delta_subframe = ts - self.last_ts_frame
-            delta_print = ts - self.last_ts_print
-            self.last_ts_print = ts
-            RATE=60.0e6
-
-            subf_print = ''
-            frame_print = ''
-
-            if self.frameno != None:
-                frame_print = "%3d" % self.frameno
-
-            if self.subframe != None:
-                subf_print = ".%d" % self.subframe
-
-            print ("%s %10.6f d=%10.6f [%3s%2s +%7.3f] [%3d] %s " % (
-                    flag_field, ts/RATE, (delta_print)/RATE,
-                    frame_print, subf_print, delta_subframe/RATE * 1E6,
-                    len(buf), msg))
+                msg += "SOF  : %d\tUnexpected ERR CRC5" % (rec.addr | rec.endp << 7)
+        else:
+            msg += name
+
+        return msg
+
+    def format(self, ctx, buf, flags, crc_ok=None):
+        return self.format_record(self.record(ctx, buf, flags, crc_ok))
+
+    def format_record(self, rec):
+        flags = rec.flags
+
+        msg = self.describe(rec)
+
+        flag_field = "[  %s%s%s%s%s%s]" % (
+            'L' if flags & 0x20 else ' ',
+            'F' if flags & 0x10 else ' ',
+            'T' if flags & 0x08 else ' ',
+            'C' if flags & 0x04 else ' ',
+            'O' if flags & 0x02 else ' ',
+            'E' if flags & 0x01 else ' ')
+        RATE=60.0e6
+
+        subf_print = ''
+        frame_print = ''
+
+        if rec.frameno != None:
+            frame_print = "%3d" % rec.frameno
+
+        if rec.subframe != None:
+            subf_print = ".%d" % rec.subframe
+
+        return "%s %10.6f d=%10.6f [%3s%2s +%7.3f] [%3d] %s " % (
+                flag_field, rec.ts/RATE, (rec.delta_print)/RATE,
+                frame_print, subf_print, rec.delta_subframe/RATE * 1E6,
+                len(rec.buf), msg)
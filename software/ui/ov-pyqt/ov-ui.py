@@ -67,16 +67,22 @@ class OV_UI(QMainWindow):
 		else:
 			self.currentIntervalCount += 1
 			
-		while len(ovctl.rxQueue) > 0 and (maxitems > 0):
-		#while maxitems > 0:
-			#packet = ovctl.outputpipe.recv()
-			packet = ovctl.rxQueue.popleft()
-			self.handlePacket(packet)
-			self.packetsPer100ms += 1
-			#print(packet)
+		# A new capture clears the store, numbering from 0 again
+		store = self.ovc.store
+		if store.generation != self.storeGeneration:
+			self.storeGeneration = store.generation
+			self.nextPacket = 0
+		
+		# Packets the store has already evicted are skipped
+		start = max(self.nextPacket, store.first)
+		for batch in store.batches(start, start + maxitems):
+			for ts, data, flags in batch:
+				self.handlePacket((ts, flags, data))
+				self.packetsPer100ms += 1
 			
-			
-			maxitems -= 1
+			start += len(batch)
+		
+		self.nextPacket = start
 		
 		
 
@@ -169,6 +175,8 @@ class OV_UI(QMainWindow):
 	
 	def resetTable(self):
 		self.row  = 1
+		self.nextPacket = 0
+		self.storeGeneration = self.ovc.store.generation
 		self.ui.rxDataTable.clear()
 		self.ui.rxDataTable.setColumnCount(4)
 		self.ui.rxDataTable.setHorizontalHeaderItem(0, QTableWidgetItem("Timestamp"))
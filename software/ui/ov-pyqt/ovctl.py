@@ -3,19 +3,25 @@
 # This needs python3.3 or greater - argparse changes behavior
 # TODO - workaround
 
+import sys
+import os
+
+# Where this script lives, so it can be started from any directory
+_uipath = os.path.dirname(os.path.abspath(__file__))
+
+# Use the host tools' LibOV, and the libov build alongside it
+sys.path.insert(0, os.path.normpath(os.path.join(_uipath, "..", "..", "host")))
+
 import LibOV
 import argparse
 import time
 
 import zipfile
 
-import sys
-import os
 import struct
 
 from PyQt5 import QtCore
 import queue
-from collections import deque
 from multiprocessing import Process, Pipe
 #import yappi
 
@@ -319,14 +325,14 @@ class LB_Test(Command):
 
 
 event_loop = queue.Queue()
-rxQueue = deque()# queue.Queue()
 #inputpipe, outputpipe = Pipe()
 
 class OVControl:
-    def __init__(self, pkg='ov3.fwpkg'):
+    def __init__(self, pkg=os.path.join(_uipath, 'ov3.fwpkg')):
         self.isopen = False
         self.speed = "hs"
-        self.queue = deque(maxlen=5000)
+        # Captured packets, the newest 64MB of them
+        self.store = LibOV.PacketStore(64 << 20)
         zfile = zipfile.ZipFile(pkg, 'r')
         mapfile = zfile.open('map.txt', 'r')
         self.bitfile = zfile.open('ov3.bit', 'r')
@@ -350,7 +356,7 @@ class OVControl:
             
         self.isopen = True
         
-        self.dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async=False)
+        self.dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async_=False)
         self.set_led(1)
         
         '''
@@ -401,7 +407,7 @@ class OVControl:
         #inputpipe.send((ts,flags,pkt))
         #print("testing")
         #self.queue.append(ts)
-        rxQueue.append((ts,flags,pkt))
+        self.store.append(ts, pkt, flags)
         
         
 class UsbPacket:
@@ -432,7 +438,10 @@ class WorkerThread(QtCore.QThread):
         #print("sent")
         #rxQueue.put(UsbPacket(ts, flags, pkt))
         #rxQueue.put_nowait(a)
-        rxQueue.append((ts,flags,pkt))
+        self.ov.store.append(ts, pkt, flags)
+
+    def handle_batch(self, batch):
+        self.ov.store.handle_batch(batch)
     
     def configure_speed(self):
         
@@ -457,13 +466,13 @@ class WorkerThread(QtCore.QThread):
             
         self.configure_speed()
         
-        rxQueue.clear()
+        self.ov.store.clear()
         
         if check_ulpi_clk(self.device):
             return
 
 
-        self.device.rxcsniff.service.handlers = [self.handle_usb]
+        self.device.rxcsniff.service.handlers = [self]
         timeout = 0
         elapsed_time = 0
         try:
@@ -533,7 +542,7 @@ def main():
     if args.config_only:
         return
 
-    dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async=False)
+    dev.dev.write(LibOV.FTDI_INTERFACE_A, b'\x00' * 512, async_=False)
 
     try:
         if hasattr(args, 'hdlr'):